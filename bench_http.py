@@ -0,0 +1,111 @@
+"""Benchmark: requests.post no executor padrão x pool aiohttp do PolarDevAI
+
+Sobe um servidor mock local imitando o endpoint de chat completions da Groq e
+mede a latência das duas estratégias.
+
+Uso: python bench_http.py [--requests 200] [--concurrency 10] [--delay-ms 5]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import requests
+from aiohttp import web
+
+# main.py exige as variáveis e grava em ./data; roda isolado num diretório temporário
+os.environ.setdefault("DISCORD_BOT_TOKEN", "bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="polardev-bench-"))
+
+import main  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "O que é um ModuleScript?"}]
+
+
+async def start_mock_server(delay_ms: float):
+    async def completions(request):
+        await request.json()
+        await asyncio.sleep(delay_ms / 1000)
+        return web.json_response({
+            "choices": [{"message": {"role": "assistant", "content": "Um ModuleScript é..."}}],
+            "usage": {"prompt_tokens": 20, "completion_tokens": 10}
+        })
+
+    app = web.Application()
+    app.router.add_post("/openai/v1/chat/completions", completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/openai/v1/chat/completions"
+
+
+async def run_batch(call, total: int, concurrency: int):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    return latencies, time.perf_counter() - start
+
+
+def report(name: str, latencies, wall: float):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{name:<28} média {statistics.mean(latencies):7.2f}ms | "
+        f"p50 {statistics.median(latencies):7.2f}ms | p95 {p95:7.2f}ms | "
+        f"total {wall:6.2f}s ({len(latencies) / wall:7.1f} req/s)"
+    )
+
+
+async def bench(args):
+    runner, url = await start_mock_server(args.delay_ms)
+    loop = asyncio.get_running_loop()
+
+    async def baseline():
+        # Comportamento antigo: sem Session, nova conexão a cada chamada
+        await loop.run_in_executor(None, lambda: requests.post(
+            url,
+            headers={"Authorization": "Bearer bench"},
+            json={"model": "x", "messages": MESSAGES},
+            timeout=60
+        ))
+
+    ai = main.PolarDevAI("bench")
+    ai.base_url = url
+
+    async def pooled():
+        await ai.make_request(MESSAGES, max_tokens=100)
+
+    try:
+        # Aquecimento para não contar a primeira conexão/import
+        await run_batch(baseline, args.concurrency, args.concurrency)
+        await run_batch(pooled, args.concurrency, args.concurrency)
+
+        print(f"{args.requests} requisições, concorrência {args.concurrency}, atraso do servidor {args.delay_ms}ms\n")
+        report("requests.post + executor", *await run_batch(baseline, args.requests, args.concurrency))
+        report("aiohttp (pool keep-alive)", *await run_batch(pooled, args.requests, args.concurrency))
+    finally:
+        await ai.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--delay-ms", type=float, default=5.0)
+    asyncio.run(bench(parser.parse_args()))
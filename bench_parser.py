@@ -0,0 +1,130 @@
+"""Benchmark: extratores com regex x RobloxResponseParser (uma passada, incremental)
+
+Gera respostas sintéticas grandes no formato "=== ARQUIVO n ===" (bem formadas e com
+cercas ``` quebradas), confere que os dois extratores concordam nas bem formadas e mede
+o tempo de cada um. Também mede o parser alimentado em pedaços, como num streaming.
+
+Uso: python bench_parser.py [--files 12] [--lines 120] [--repeat 20] [--chunk 64]
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+# main.py exige as variáveis e grava em ./data; roda isolado num diretório temporário
+os.environ.setdefault("DISCORD_BOT_TOKEN", "bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="polardev-bench-"))
+
+import main  # noqa: E402
+
+FILE_PATTERN = r'===+\s*ARQUIVO\s*\d+:\s*([\w\/\-\.]+\.(?:server\.lua|client\.lua|lua))\s*===+'
+FENCE_PATTERN = r'```(?:lua|luau)?\s*(.*?)\s*```'
+GUIDE_PATTERNS = [
+    r'INSTRUÇÕES[:\s]*\n?(.*?)(?=\n\n|\n===|$)',
+    r'INSTALAÇÃO[:\s]*\n?(.*?)(?=\n\n|\n===|$)',
+    r'COMO INSTALAR[:\s]*\n?(.*?)(?=\n\n|\n===|$)',
+    r'ROBLOX STUDIO[:\s]*\n?(.*?)(?=\n\n|\n===|$)'
+]
+
+
+def legacy_extract(text: str):
+    """Cópia do extrator antigo (re.finditer + re.search DOTALL por seção + 4 regex do guia)"""
+    blocks = []
+    file_matches = list(re.finditer(FILE_PATTERN, text, re.IGNORECASE))
+    if file_matches:
+        for i, match in enumerate(file_matches):
+            filename = match.group(1).strip()
+            end_pos = file_matches[i + 1].start() if i < len(file_matches) - 1 else len(text)
+            code = text[match.end():end_pos].strip()
+            code_match = re.search(FENCE_PATTERN, code, re.DOTALL)
+            if code_match:
+                code = code_match.group(1).strip()
+            if code and len(code) > 10:
+                blocks.append((filename, code))
+    else:
+        for i, block in enumerate(re.findall(FENCE_PATTERN, text, re.DOTALL)):
+            if block.strip():
+                blocks.append((f"Sistema_{i+1}.server.lua", block.strip()))
+
+    guide = main.DEFAULT_INSTALLATION_GUIDE
+    for pattern in GUIDE_PATTERNS:
+        match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+        if match and len(match.group(1).strip()) > 50:
+            guide = match.group(1).strip()
+            break
+    return blocks, guide
+
+
+def parser_extract(text: str, chunk: int = 0):
+    parser = main.RobloxResponseParser(main.PolarDevAI.determine_roblox_path)
+    if chunk:
+        for i in range(0, len(text), chunk):
+            parser.feed(text[i:i + chunk])
+    else:
+        parser.feed(text)
+    parser.close()
+    return [(b["filename"], b["code"]) for b in parser.blocks], parser.guide
+
+
+def lua_body(n: int, lines: int) -> str:
+    body = [f"-- Módulo {n}", "local Players = game:GetService(\"Players\")", "local module = {}"]
+    for i in range(lines):
+        body.append(f"function module.acao{i}(player) if player then return {i} * 2 end end")
+    body.append("return module")
+    return "\n".join(body)
+
+
+def build_response(files: int, lines: int, broken: bool) -> str:
+    parts = ["Aqui está o sistema completo pedido.\n"]
+    for n in range(1, files + 1):
+        suffix = ("server.lua", "client.lua", "module.lua")[n % 3]
+        parts.append(f"=== ARQUIVO {n}: ServerScriptService/Sistema/Parte{n}.{suffix} ===")
+        parts.append("Explicação rápida do arquivo.")
+        # Cercas quebradas: abre e nunca fecha, forçando o .*? a varrer até o fim
+        closing = "" if broken and n % 2 else "```"
+        parts.append(f"```lua\n{lua_body(n, lines)}\n{closing}\n")
+    parts.append("INSTRUÇÕES DE INSTALAÇÃO:\n")
+    parts.append("\n".join(f"{i}. Coloque a Parte{i} na pasta indicada e teste no Play Solo." for i in range(1, files + 1)))
+    parts.append("\n=== FIM ===")
+    return "\n".join(parts)
+
+
+def measure(func, text: str, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main_bench(args):
+    for broken in (False, True):
+        text = build_response(args.files, args.lines, broken)
+        label = "cercas quebradas" if broken else "bem formada"
+        legacy, parsed = legacy_extract(text), parser_extract(text)
+        streamed = parser_extract(text, args.chunk)
+        assert parsed == streamed, "parser em pedaços divergiu do parser de uma vez"
+        if not broken:
+            assert legacy == parsed, "parser divergiu do extrator antigo"
+
+        print(f"\nResposta {label}: {len(text) / 1024:.1f} KiB, ~{main.estimate_tokens(text)} tokens, "
+              f"{len(parsed[0])} arquivos (regex: {len(legacy[0])})")
+        print(f"  {'regex (antigo)':<26} {measure(legacy_extract, text, args.repeat):8.2f}ms")
+        print(f"  {'parser (texto inteiro)':<26} {measure(parser_extract, text, args.repeat):8.2f}ms")
+        print(f"  {f'parser (pedaços de {args.chunk})':<26} "
+              f"{measure(lambda t: parser_extract(t, args.chunk), text, args.repeat):8.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=12)
+    parser.add_argument("--lines", type=int, default=120)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--chunk", type=int, default=64)
+    main_bench(parser.parse_args())
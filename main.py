@@ -2,40 +2,33 @@ import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 import os
+import sys
+import traceback
 import random
 import string
+import io
 import json
+import hashlib
+import zipfile
+import math
+import heapq
+import bisect
+import unicodedata
+import sqlite3
 import asyncio
 import re
 import logging
-import requests
+import aiohttp
+from aiohttp import web
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from collections import deque, OrderedDict, Counter
+from typing import Optional, List, Dict, Any, AsyncIterator, Callable
+from contextlib import contextmanager, asynccontextmanager
 from dotenv import load_dotenv
+from email.utils import parsedate_to_datetime
+from xml.sax.saxutils import escape as xml_escape
 import time
-from flask import Flask
-from threading import Thread
-
-# ================= FLASK PARA KEEP-ALIVE =================
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "🤖 PolarDev Bot está online! | Status: ✅ Ativo"
-
-@app.route('/health')
-def health():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
-
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
-
-def keep_alive():
-    """Mantém o bot ativo no Render"""
-    t = Thread(target=run_flask)
-    t.daemon = True
-    t.start()
-    print("✅ Flask server iniciado na porta 8080")
+from threading import Thread, Lock, RLock, Event, get_ident
 
 # ================= CONFIGURAÇÃO =================
 load_dotenv()
@@ -44,12 +37,130 @@ TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 CEO_ROLE = os.getenv("CEO_ROLE_NAME", "CEO")
 SUPPORT_ROLE = os.getenv("SUPPORT_ROLE_NAME", "SUPPORT")
 CATEGORY_NAME = "🤖 PolarDev Chats"
+# Limite de canais por categoria do Discord; ao encher, cria "🤖 PolarDev Chats 2", 3, ...
+CATEGORY_CHANNEL_LIMIT = int(os.getenv("CATEGORY_CHANNEL_LIMIT", "50"))
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
 KEY_PREFIX = "PD-"
 KEY_LENGTH = 16
 COST_PER_CREATION = 1.0
 
+# Backend do banco: "json" (snapshot + journal) ou "sqlite"
+DB_BACKEND = os.getenv("DB_BACKEND", "json").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data/polardev.db")
+
+# Pool HTTP da Groq: conexões totais, simultâneas por host e tempo de keep-alive
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "8"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+
+# Respostas do chat em stream: intervalo mínimo entre edições e caracteres novos por edição
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_EDIT_MIN_CHARS = int(os.getenv("STREAM_EDIT_MIN_CHARS", "40"))
+
+# Janela para juntar mensagens seguidas do dono do chat numa única pergunta (0 = sem espera)
+CHAT_DEBOUNCE_SECONDS = float(os.getenv("CHAT_DEBOUNCE_SECONDS", "2.0"))
+
+# Cache de respostas do chat (LRU + TTL), opcionalmente persistido em data/
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", str(2 * 1024 * 1024)))
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_FILE = "data/response_cache.json"
+
+# Cache de sistemas parecidos (TF-IDF local): similaridade mínima, tamanho e idade máxima
+SYSTEM_CACHE_THRESHOLD = float(os.getenv("SYSTEM_CACHE_THRESHOLD", "0.65"))
+SYSTEM_CACHE_MAX_ENTRIES = int(os.getenv("SYSTEM_CACHE_MAX_ENTRIES", "200"))
+SYSTEM_CACHE_MAX_AGE = float(os.getenv("SYSTEM_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+SYSTEM_CACHE_FILE = "data/system_cache.json"
+
+# Hash da árvore de comandos já sincronizada; o boot só chama tree.sync() quando ela muda
+COMMAND_TREE_HASH_FILE = "data/command_tree.sha256"
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "false").lower() == "true"
+
+# Fila global da IA: requisições simultâneas à Groq e intervalo de atualização da posição
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "4"))
+QUEUE_POSITION_REFRESH = float(os.getenv("QUEUE_POSITION_REFRESH", "3"))
+
+# Roteador de modelos: modelos disponíveis, janela de erros, disjuntor e backoff
+GROQ_MODELS = [m.strip() for m in os.getenv("GROQ_MODELS", "llama3-70b-8192,mixtral-8x7b-32768,gemma-7b-it").split(",") if m.strip()]
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "20"))
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.3"))
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", "3"))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", "60"))
+ROUTER_DEFAULT_COOLDOWN = float(os.getenv("ROUTER_DEFAULT_COOLDOWN", "20"))
+ROUTER_MAX_BACKOFF = float(os.getenv("ROUTER_MAX_BACKOFF", "30"))
+
+# Orçamento de tokens: folga na janela, saída mínima aceitável e limite da descrição das criações
+TOKEN_SAFETY_MARGIN = int(os.getenv("TOKEN_SAFETY_MARGIN", "128"))
+MIN_OUTPUT_TOKENS = int(os.getenv("MIN_OUTPUT_TOKENS", "512"))
+CREATION_DESCRIPTION_MAX_TOKENS = int(os.getenv("CREATION_DESCRIPTION_MAX_TOKENS", "600"))
+
+# Memória de conversa por canal: orçamento de tokens, limite por turno e do resumo, ociosidade
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "1500"))
+CONVERSATION_MAX_TURN_TOKENS = int(os.getenv("CONVERSATION_MAX_TURN_TOKENS", "500"))
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "300"))
+CONVERSATION_IDLE_SECONDS = float(os.getenv("CONVERSATION_IDLE_SECONDS", "900"))
+CONVERSATIONS_DIR = "data/conversations"
+
+# Entrega das criações: scripts maiores que isso vão como anexo .lua em vez de texto no embed
+INLINE_CODE_MAX_CHARS = int(os.getenv("INLINE_CODE_MAX_CHARS", "1500"))
+CREATION_BUNDLE = os.getenv("CREATION_BUNDLE", "true").lower() in ("1", "true", "yes")
+
+# Fila durável das criações: workers simultâneos, tempo máximo por job (0 = sem limite),
+# tentativas antes de reembolsar e por quanto tempo jobs finalizados ficam guardados
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(24 * 3600)))
+# Tempo máximo de uma chamada à Groq de criação (sem stream, a resposta só chega no fim);
+# o chat continua com o limite de 60s. 0 = só o JOB_TIMEOUT limita
+LLM_CREATION_TIMEOUT = float(os.getenv("LLM_CREATION_TIMEOUT", "300"))
+
+# Expiração dos chats: dias sem atividade, intervalo do agendador, canais apagados por vez,
+# espaço entre exclusões e de quanto em quanto tempo a última atividade vai para o banco
+CHAT_EXPIRY_DAYS = float(os.getenv("CHAT_EXPIRY_DAYS", "30"))
+CHAT_EXPIRY_INTERVAL = float(os.getenv("CHAT_EXPIRY_INTERVAL", "60"))
+CHAT_EXPIRY_BATCH = int(os.getenv("CHAT_EXPIRY_BATCH", "5"))
+CHAT_EXPIRY_DELETE_SPACING = float(os.getenv("CHAT_EXPIRY_DELETE_SPACING", "1.0"))
+CHAT_ACTIVITY_PERSIST = float(os.getenv("CHAT_ACTIVITY_PERSIST", "3600"))
+CHAT_ARCHIVE_DIR = "data/archive"
+
+# Servidor HTTP (health checks, métricas) no mesmo loop do bot; o Render informa a porta em PORT
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", "8080"))
+
+# Health checks: intervalo entre avaliações da saúde, atraso máximo do loop e tamanho máximo
+# da fila de gravação do banco. O /health/live roda no loop do bot: loop travado = probe sem
+# resposta, então o timeout do probe (no Render) é o que detecta o travamento
+HEALTH_HEARTBEAT_INTERVAL = float(os.getenv("HEALTH_HEARTBEAT_INTERVAL", "1.0"))
+HEALTH_MAX_LOOP_LAG_MS = float(os.getenv("HEALTH_MAX_LOOP_LAG_MS", "500"))
+HEALTH_MAX_DB_BACKLOG = int(os.getenv("HEALTH_MAX_DB_BACKLOG", "5000"))
+
+# Watchdog do loop: uma thread confere o heartbeat do HealthMonitor (que bate a cada metade do
+# limite) e, quando ele atrasa, captura a pilha do que está bloqueando. LOOP_WATCHDOG_SAMPLE_MS = intervalo
+# entre amostras durante o travamento (0 = só a primeira captura)
+LOOP_WATCHDOG_ENABLED = os.getenv("LOOP_WATCHDOG_ENABLED", "true").lower() == "true"
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+LOOP_WATCHDOG_SAMPLE_MS = float(os.getenv("LOOP_WATCHDOG_SAMPLE_MS", "50"))
+LOOP_WATCHDOG_CAPTURES = int(os.getenv("LOOP_WATCHDOG_CAPTURES", "20"))
+
+# Limite de taxa (token bucket) por usuário e por servidor: "comando=rajada/segundos",
+# em que a rajada inteira se recupera em `segundos`; "default" vale para os demais comandos
+RATE_LIMITS = os.getenv("RATE_LIMITS", "chat=6/30,criar_sistema=2/120,resgatar=5/60,criar_chat=2/300,default=10/30")
+GUILD_RATE_LIMITS = os.getenv("GUILD_RATE_LIMITS", "chat=60/60,criar_sistema=10/60,resgatar=30/60,default=120/60")
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "20000"))
+
+# Journal do banco: intervalo do fsync em lote e gatilhos de compactação
+JOURNAL_FSYNC_INTERVAL = float(os.getenv("JOURNAL_FSYNC_INTERVAL", "0.5"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(1024 * 1024)))
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "600"))
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", "256"))
+
+# SQLite: o checkpoint do WAL (que faz fsync) roda numa thread a cada N segundos, nunca num commit
+SQLITE_CHECKPOINT_INTERVAL = float(os.getenv("SQLITE_CHECKPOINT_INTERVAL", "5"))
+
 COLORS = {
     "primary": 0x5865F2,
     "success": 0x57F287,
@@ -74,111 +185,2242 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ================= BANCO DE DADOS SIMPLES =================
-class Database:
-    def __init__(self):
-        self.data_dir = "data"
-        os.makedirs(self.data_dir, exist_ok=True)
-        
-        self.users_file = f"{self.data_dir}/users.json"
-        self.keys_file = f"{self.data_dir}/keys.json"
-        self.chats_file = f"{self.data_dir}/chats.json"
-        
-        self.load_data()
-    
-    def load_data(self):
-        self.users = self._load_json(self.users_file)
-        self.keys = self._load_json(self.keys_file)
-        self.chats = self._load_json(self.chats_file)
+# ================= TEMPO DE INICIALIZAÇÃO =================
+class StartupTimer:
+    """Marca o fim de cada fase do boot e loga o relatório quando o bot fica pronto"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[tuple] = []  # (fase, segundos)
+        self.reported = False
+        self._last = self.started
+    
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+    
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        total = time.perf_counter() - self.started
+        phases = " | ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases)
+        logger.info(f"⏱️ Inicialização em {total:.2f}s: {phases}")
+
+startup = StartupTimer()
+
+# ================= MÉTRICAS =================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class CounterMetric:
+    """Contador com labels. Um Lock por métrica (sem contenção na prática) deixa o
+    /metrics ler de outra thread enquanto o loop e a thread de gravação atualizam"""
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, float] = {}
+        self._lock = Lock()
+    
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value:g}" for key, value in values]
+
+class HistogramMetric:
+    """Histograma com buckets fixos (contagem por bucket, acumulada só na exportação)"""
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[tuple, list] = {}   # labels -> [contagem por bucket..., +Inf, soma]
+        self._lock = Lock()
+    
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        lines = []
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                le = 'le="%s"' % (bound if isinstance(bound, str) else f"{bound:g}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {values[-1]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Métricas no formato texto do Prometheus (/metrics)"""
+    def __init__(self):
+        self._metrics: List[Any] = []
+    
+    def counter(self, name: str, help_text: str, labels=()) -> CounterMetric:
+        metric = CounterMetric(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS) -> HistogramMetric:
+        metric = HistogramMetric(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    @staticmethod
+    def render_stats(component: str, stats: Dict[str, Any], by_key: bool = False) -> List[str]:
+        """Converte o stats() de um componente em gauges polardev_<componente>_<campo>
+        
+        Campos que são dicts viram um label key=...; com by_key=True o próprio stats é
+        {chave: {campo: valor}} (um item por modelo ou por comando).
+        """
+        gauges: Dict[str, List[str]] = {}
+        
+        def add(field: str, value, key=None):
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                return
+            name = re.sub(r'[^a-zA-Z0-9_]', '_', f"polardev_{component}_{field}")
+            labels = f'{{key="{_label_value(key)}"}}' if key is not None else ""
+            gauges.setdefault(name, []).append(f"{name}{labels} {value:g}")
+        
+        for field, value in stats.items():
+            if by_key and isinstance(value, dict):
+                for inner_field, inner_value in value.items():
+                    add(inner_field, inner_value, key=field)
+            elif isinstance(value, dict):
+                for key, inner_value in value.items():
+                    add(field, inner_value, key=key)
+            else:
+                add(field, value)
+        
+        lines = []
+        for name, samples in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return lines
+    
+    def render(self, gauges: Optional[List[str]] = None) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        lines.extend(gauges or [])
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+llm_call_seconds = metrics.histogram(
+    "polardev_llm_call_seconds", "Chamada completa à IA, incluindo fila e troca de modelo", ("command", "outcome"))
+llm_queue_wait_seconds = metrics.histogram(
+    "polardev_llm_queue_wait_seconds", "Espera por uma vaga na fila global da IA", ("lane",))
+llm_attempt_seconds = metrics.histogram(
+    "polardev_llm_attempt_seconds", "Requisição HTTP à Groq por modelo (stream: até o primeiro token)", ("model", "status"))
+command_seconds = metrics.histogram(
+    "polardev_command_seconds", "Duração dos slash commands", ("command", "outcome"))
+on_message_seconds = metrics.histogram(
+    "polardev_on_message_seconds", "Duração do handler on_message", ("outcome",))
+chat_reply_seconds = metrics.histogram(
+    "polardev_chat_reply_seconds", "Resposta completa a um lote de mensagens do chat", ("mode",))
+db_flush_seconds = metrics.histogram(
+    "polardev_db_flush_seconds", "Gravação de um lote do journal (write + fsync)")
+db_compact_seconds = metrics.histogram(
+    "polardev_db_compact_seconds", "Compactação do banco (snapshots JSON)")
+discord_send_seconds = metrics.histogram(
+    "polardev_discord_send_seconds", "Envio de mensagem ao Discord (REST)", ("route",))
+code_delivery_seconds = metrics.histogram(
+    "polardev_code_delivery_seconds", "Entrega completa do código de uma criação")
+credits_total = metrics.counter(
+    "polardev_credits_total", "Créditos movimentados", ("operation",))
+
+# ================= BANCO DE DADOS SIMPLES =================
+# Estados dos jobs de criação (tabela "jobs")
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_REFUNDED = "refunded"
+JOB_PENDING_STATES = (JOB_QUEUED, JOB_RUNNING)
+
+def write_file_atomic(filename: str, payload: str):
+    """Escreve o arquivo de forma atômica (arquivo temporário + fsync + rename)"""
+    tmp = f"{filename}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except Exception as e:
+        logger.error(f"Erro ao salvar {filename}: {e}")
+        raise
+
+class Journal:
+    """Log append-only das mutações do banco (uma linha JSON por operação)
+    
+    append() só enfileira em memória; a escrita e o fsync acontecem na thread
+    de gravação do Database, em lotes.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = Lock()      # fila de pendentes (loop do bot x thread de gravação)
+        self._io_lock = Lock()   # arquivo (sync x rotate x close)
+        self._pending = deque()
+        self._wakeup = Event()
+        
+        # Métricas da fila de gravação
+        self.max_queue_depth = 0
+        self.records_written = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.last_flush_at = None
+        
+        self._open()
+    
+    def _open(self):
+        self._file = open(self.filename, 'a', encoding='utf-8')
+        self.size = os.path.getsize(self.filename)
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+    
+    def append(self, *records: Dict):
+        """Registra novos valores de linhas (v=None = remoção). Custo O(1), sem I/O.
+        
+        Vários registros viram uma única linha, aplicada inteira ou descartada no replay.
+        """
+        entry = records[0] if len(records) == 1 else {"b": list(records)}
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with self._lock:
+            self._pending.append(line)
+            self.size += len(line)
+            depth = len(self._pending)
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+        
+        if depth >= JOURNAL_BATCH_SIZE:
+            self._wakeup.set()
+    
+    def wait_for_work(self, timeout: float):
+        """Bloqueia a thread de gravação até o próximo lote (no máximo `timeout`)"""
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+    
+    def _take_pending(self):
+        with self._lock:
+            batch, self._pending = self._pending, deque()
+        return batch
+    
+    def _write_batch(self, batch):
+        start = time.perf_counter()
+        self._file.write("".join(batch))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        
+        self.records_written += len(batch)
+        self.flushes += 1
+        elapsed = time.perf_counter() - start
+        self.last_flush_ms = elapsed * 1000
+        self.last_flush_at = time.time()
+        db_flush_seconds.observe(elapsed)
+    
+    def sync(self):
+        """Grava todas as operações pendentes com um único fsync"""
+        with self._io_lock:
+            batch = self._take_pending()
+            if batch:
+                self._write_batch(batch)
+    
+    def rotate(self) -> str:
+        """Fecha o journal atual, renomeia para .1 e abre um novo vazio"""
+        rotated = f"{self.filename}.1"
+        with self._io_lock:
+            with self._lock:
+                batch, self._pending = self._pending, deque()
+                self.size = 0
+            if batch:
+                self._write_batch(batch)
+            self._file.close()
+            if os.path.exists(rotated):
+                # Compactação anterior falhou: preserva as operações ainda não consolidadas
+                with open(rotated, 'a', encoding='utf-8') as dst, open(self.filename, 'r', encoding='utf-8') as src:
+                    dst.write(src.read())
+                os.remove(self.filename)
+            else:
+                os.replace(self.filename, rotated)
+            self._open()
+        return rotated
+    
+    def close(self):
+        self.sync()
+        with self._io_lock:
+            self._file.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "records_written": self.records_written,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "last_flush_at": self.last_flush_at,
+            "journal_bytes": self.size
+        }
+
+    @staticmethod
+    def replay(filename: str, tables: Dict[str, Dict]) -> int:
+        """Reaplica as operações de um journal sobre as tabelas em memória"""
+        if not os.path.exists(filename):
+            return 0
+        
+        applied = 0
+        good_end = 0  # byte logo após a última linha válida
+        with open(filename, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Última linha incompleta (queda durante a escrita)
+                    logger.warning(f"Journal {filename} truncado após {applied} operações")
+                    break
+                
+                for op in record.get("b", [record]):
+                    table = tables[op["t"]]
+                    if op["v"] is None:
+                        table.pop(op["k"], None)
+                    else:
+                        table[op["k"]] = op["v"]
+                applied += 1
+                good_end += len(line)
+        
+        Journal._repair_tail(filename, good_end)
+        return applied
+    
+    @staticmethod
+    def _repair_tail(filename: str, good_end: int):
+        """Corta o que vem depois da última linha válida, para o próximo append não colar nela
+        
+        Os bytes descartados vão para `.corrupt`, caso alguém queira inspecionar.
+        """
+        with open(filename, 'r+b') as f:
+            f.seek(good_end)
+            torn = f.read()
+            if torn:
+                with open(f"{filename}.corrupt", 'ab') as dump:
+                    dump.write(torn)
+                f.truncate(good_end)
+                logger.warning(f"Journal {filename}: {len(torn)} bytes inválidos removidos do final")
+            if good_end:
+                # Linha válida sem quebra no final (queda entre o JSON e o \n)
+                f.seek(good_end - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+class Database:
+    def __init__(self):
+        self.data_dir = "data"
+        os.makedirs(self.data_dir, exist_ok=True)
+        
+        self.users_file = f"{self.data_dir}/users.json"
+        self.keys_file = f"{self.data_dir}/keys.json"
+        self.chats_file = f"{self.data_dir}/chats.json"
+        self.jobs_file = f"{self.data_dir}/jobs.json"
+        self.journal_file = f"{self.data_dir}/journal.log"
+        
+        # Protege as tabelas entre o loop do bot e a thread de compactação
+        self._lock = RLock()
+        # Uma compactação por vez (thread de gravação x save_all/close)
+        self._compact_lock = Lock()
+        self._stop = Event()
+        
+        self.load_data()
+        
+        self._last_compaction = time.monotonic()
+        self._sync_thread = Thread(target=self._background_loop, name="db-journal", daemon=True)
+        self._sync_thread.start()
+    
+    def load_data(self):
+        self.users = self._load_json(self.users_file)
+        self.keys = self._load_json(self.keys_file)
+        self.chats = self._load_json(self.chats_file)
+        self.jobs = self._load_json(self.jobs_file)
+        self._tables = {"users": self.users, "keys": self.keys, "chats": self.chats, "jobs": self.jobs}
+        
+        # Snapshot + journal (incluindo um .1 deixado por compactação interrompida)
+        replayed = Journal.replay(f"{self.journal_file}.1", self._tables)
+        replayed += Journal.replay(self.journal_file, self._tables)
+        
+        self._rebuild_owner_index()
+        
+        self.journal = Journal(self.journal_file)
+        if replayed:
+            logger.info(f"Journal: {replayed} operações reaplicadas")
+            self.compact()
+    
+    def _rebuild_owner_index(self):
+        """Índice dono -> canais, montado a partir dos chats ao carregar o banco"""
+        self.chats_by_owner: Dict[str, set] = {}
+        for channel_id, chat_data in self.chats.items():
+            self.chats_by_owner.setdefault(str(chat_data["owner_id"]), set()).add(channel_id)
+    
+    def _unindex_chat(self, channel_id, chat_data):
+        owner_id = str(chat_data["owner_id"])
+        channels = self.chats_by_owner.get(owner_id)
+        if channels is not None:
+            channels.discard(channel_id)
+            if not channels:
+                del self.chats_by_owner[owner_id]
+    
+    def _load_json(self, filename):
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except:
+                return {}
+        return {}
+    
+    def _record(self, *rows):
+        """Registra no journal o estado atual das linhas (tabela, chave) de forma atômica"""
+        self.journal.append(*({"t": table, "k": key, "v": self._tables[table].get(key)} for table, key in rows))
+    
+    def compact(self):
+        """Grava snapshots completos e descarta o journal já consolidado"""
+        with self._compact_lock:
+            self._compact()
+    
+    def _compact(self):
+        started = time.perf_counter()
+        # Sob o lock só uma cópia rasa (as linhas são alteradas no lugar); serializar fica
+        # fora, para a compactação não segurar o loop pelo tempo do banco inteiro
+        with self._lock:
+            snapshots = {
+                self.users_file: {key: dict(row) for key, row in self.users.items()},
+                self.keys_file: {key: dict(row) for key, row in self.keys.items()},
+                self.chats_file: {key: dict(row) for key, row in self.chats.items()},
+                self.jobs_file: {key: dict(row) for key, row in self.jobs.items()}
+            }
+            rotated = self.journal.rotate()
+        
+        try:
+            for filename, snapshot in snapshots.items():
+                write_file_atomic(filename, json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')))
+        except Exception:
+            # O .1 continua no disco e será reaplicado no próximo início
+            return
+        
+        os.remove(rotated)
+        self._last_compaction = time.monotonic()
+        db_compact_seconds.observe(time.perf_counter() - started)
+    
+    def _background_loop(self):
+        """Thread de gravação: fsync em lote do journal e compactação periódica"""
+        while not self._stop.is_set():
+            self.journal.wait_for_work(JOURNAL_FSYNC_INTERVAL)
+            try:
+                self.journal.sync()
+                
+                compaction_due = time.monotonic() - self._last_compaction >= JOURNAL_COMPACT_INTERVAL
+                if self.journal.size >= JOURNAL_COMPACT_BYTES or (compaction_due and self.journal.size > 0):
+                    self.compact()
+            except Exception as e:
+                logger.error(f"Erro no journal: {e}")
+    
+    def save_all(self):
+        """Força uma compactação imediata"""
+        self.compact()
+    
+    def close(self):
+        """Esvazia a fila de gravação, para a thread e consolida tudo em snapshot"""
+        if self._stop.is_set():
+            return
+        pending = self.journal.queue_depth
+        self._stop.set()
+        self.journal._wakeup.set()
+        self._sync_thread.join(timeout=5)
+        self.compact()
+        self.journal.close()
+        logger.info(f"Banco fechado ({pending} operações drenadas na saída)")
+    
+    def writer_stats(self) -> Dict[str, Any]:
+        return self.journal.stats()
+    
+    def get_user(self, user_id):
+        return self.users.get(str(user_id))
+    
+    def create_user(self, user_id):
+        user_data = {
+            "credits": 0.0,
+            "created_at": datetime.now().isoformat(),
+            "keys_redeemed": 0,
+            "total_creations": 0,
+            "last_activity": datetime.now().isoformat()
+        }
+        with self._lock:
+            self.users[str(user_id)] = user_data
+            self._record(("users", str(user_id)))
+        return user_data
+    
+    def add_credits(self, user_id, amount):
+        user_id = str(user_id)
+        with self._lock:
+            if user_id not in self.users:
+                self.create_user(user_id)
+            
+            user = self.users[user_id]
+            user["credits"] = round(user.get("credits", 0) + amount, 2)
+            user["keys_redeemed"] = user.get("keys_redeemed", 0) + 1
+            user["last_activity"] = datetime.now().isoformat()
+            self._record(("users", user_id))
+        return user["credits"]
+    
+    def deduct_credits(self, user_id, amount):
+        user = self.get_user(user_id)
+        if not user or user["credits"] < amount:
+            return False
+        
+        with self._lock:
+            user["credits"] = round(user["credits"] - amount, 2)
+            user["total_creations"] = user.get("total_creations", 0) + 1
+            user["last_activity"] = datetime.now().isoformat()
+            self._record(("users", str(user_id)))
+        return True
+    
+    def create_key(self, key, created_by, credits):
+        with self._lock:
+            self.keys[key] = {
+                "created_by": created_by,
+                "created_at": datetime.now().isoformat(),
+                "credits": credits,
+                "used": False
+            }
+            self._record(("keys", key))
+        return True
+    
+    def use_key(self, key, user_id):
+        if key in self.keys and not self.keys[key]["used"]:
+            with self._lock:
+                credits = self.keys[key]["credits"]
+                self.keys[key]["used"] = True
+                self.keys[key]["used_by"] = str(user_id)
+                self.keys[key]["used_at"] = datetime.now().isoformat()
+                self._record(("keys", key))
+            return credits
+        return None
+    
+    def register_chat(self, channel_id, owner_id, channel_name):
+        channel_id = str(channel_id)
+        with self._lock:
+            previous = self.chats.get(channel_id)
+            if previous is not None:
+                self._unindex_chat(channel_id, previous)
+            self.chats[channel_id] = {
+                "owner_id": owner_id,
+                "channel_name": channel_name,
+                "created_at": datetime.now().isoformat()
+            }
+            self.chats_by_owner.setdefault(str(owner_id), set()).add(channel_id)
+            self._record(("chats", channel_id))
+    
+    def redeem_key(self, key, user_id):
+        """Marca a key como usada e credita o usuário numa única operação do journal"""
+        user_id = str(user_id)
+        with self._lock:
+            key_data = self.keys.get(key)
+            if not key_data or key_data["used"]:
+                return None
+            
+            credits = key_data["credits"]
+            key_data["used"] = True
+            key_data["used_by"] = user_id
+            key_data["used_at"] = datetime.now().isoformat()
+            
+            user = self.users.get(user_id)
+            if user is None:
+                user = self.users[user_id] = {
+                    "credits": 0.0,
+                    "created_at": datetime.now().isoformat(),
+                    "keys_redeemed": 0,
+                    "total_creations": 0
+                }
+            user["credits"] = round(user.get("credits", 0) + credits, 2)
+            user["keys_redeemed"] = user.get("keys_redeemed", 0) + 1
+            user["last_activity"] = datetime.now().isoformat()
+            
+            self._record(("keys", key), ("users", user_id))
+        return credits, user["credits"]
+    
+    def get_chat(self, channel_id):
+        return self.chats.get(str(channel_id))
+    
+    def touch_chat(self, channel_id):
+        """Atualiza a última atividade do chat"""
+        with self._lock:
+            chat_data = self.chats.get(str(channel_id))
+            if chat_data is None:
+                return False
+            chat_data["last_activity"] = datetime.now().isoformat()
+            self._record(("chats", str(channel_id)))
+        return True
+    
+    def get_owner_chats(self, owner_id):
+        """Canais registrados do usuário, via índice (O(1))"""
+        return list(self.chats_by_owner.get(str(owner_id), ()))
+    
+    def iter_chats(self):
+        return list(self.chats.items())
+    
+    def count_users(self):
+        return len(self.users)
+    
+    def count_chats(self):
+        return len(self.chats)
+    
+    def remove_chat(self, channel_id):
+        channel_id = str(channel_id)
+        with self._lock:
+            chat_data = self.chats.pop(channel_id, None)
+            if chat_data is None:
+                return False
+            self._unindex_chat(channel_id, chat_data)
+            self._record(("chats", channel_id))
+        return True
+    
+    def enqueue_job(self, job_id, user_id, channel_id, message_id, description, use_cache, cost):
+        """Cobra os créditos e cria o job numa única operação do journal (None = saldo insuficiente)"""
+        user_id = str(user_id)
+        now = datetime.now().isoformat()
+        with self._lock:
+            user = self.users.get(user_id)
+            if not user or user["credits"] < cost:
+                return None
+            
+            user["credits"] = round(user["credits"] - cost, 2)
+            user["total_creations"] = user.get("total_creations", 0) + 1
+            user["last_activity"] = now
+            self.jobs[job_id] = {
+                "user_id": user_id,
+                "channel_id": str(channel_id),
+                "message_id": str(message_id) if message_id else None,
+                "description": description,
+                "use_cache": use_cache,
+                "cost": cost,
+                "state": JOB_QUEUED,
+                "attempts": 0,
+                "error": None,
+                "created_at": now,
+                "updated_at": now
+            }
+            self._record(("users", user_id), ("jobs", job_id))
+            return dict(self.jobs[job_id])
+    
+    def get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        return dict(job) if job else None
+    
+    def update_job(self, job_id, **fields):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            job.update(fields, updated_at=datetime.now().isoformat())
+            self._record(("jobs", job_id))
+        return True
+    
+    def refund_job(self, job_id, error=None):
+        """Devolve os créditos de um job pendente e marca como reembolsado (retorna o novo saldo)"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["state"] not in JOB_PENDING_STATES:
+                return None
+            
+            now = datetime.now().isoformat()
+            user = self.users.get(job["user_id"])
+            if user is None:
+                user = self.users[job["user_id"]] = {
+                    "credits": 0.0,
+                    "created_at": now,
+                    "keys_redeemed": 0,
+                    "total_creations": 0
+                }
+            user["credits"] = round(user.get("credits", 0) + job["cost"], 2)
+            user["last_activity"] = now
+            job.update(state=JOB_REFUNDED, error=error, updated_at=now)
+            
+            self._record(("users", job["user_id"]), ("jobs", job_id))
+        return user["credits"]
+    
+    def pending_jobs(self):
+        """Jobs na fila ou em execução, do mais antigo para o mais novo"""
+        with self._lock:
+            pending = [(job_id, dict(job)) for job_id, job in self.jobs.items() if job["state"] in JOB_PENDING_STATES]
+        return sorted(pending, key=lambda item: item[1]["created_at"])
+    
+    def prune_jobs(self, older_than):
+        """Remove jobs finalizados com updated_at anterior a `older_than` (ISO)"""
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job["state"] not in JOB_PENDING_STATES and job["updated_at"] < older_than
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
+            if expired:
+                self._record(*(("jobs", job_id) for job_id in expired))
+        return len(expired)
+
+class SQLiteDatabase:
+    """Backend SQLite (WAL) com a mesma API do Database"""
+    USER_COLUMNS = ("credits", "created_at", "keys_redeemed", "total_creations", "last_activity")
+    CHAT_COLUMNS = ("owner_id", "channel_name", "created_at")
+    JOB_COLUMNS = ("user_id", "channel_id", "message_id", "description", "use_cache", "cost",
+                   "state", "attempts", "error", "created_at", "updated_at")
+    
+    def __init__(self, path: str = "data/polardev.db"):
+        self.data_dir = os.path.dirname(path) or "."
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.path = path
+        
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Sem checkpoint automático: ele rodaria (com fsync) dentro do commit que cruzasse o
+        # limite de páginas, no loop do bot. Quem faz é a thread de checkpoint
+        self.conn.execute("PRAGMA wal_autocheckpoint=0")
+        self._create_schema()
+        
+        if self._get_meta("migrated_from_json") is None:
+            migrate_json_to_sqlite(self, self.data_dir)
+        
+        self.checkpoints = 0
+        self.last_checkpoint_ms = 0.0
+        self.wal_frames = 0
+        self._stop = Event()
+        self._checkpoint_thread = Thread(target=self._checkpoint_loop, name="db-checkpoint", daemon=True)
+        self._checkpoint_thread.start()
+    
+    def _checkpoint_loop(self):
+        """Thread de checkpoint, com conexão própria para não disputar a do loop"""
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            while not self._stop.wait(SQLITE_CHECKPOINT_INTERVAL):
+                try:
+                    self._checkpoint(conn)
+                except sqlite3.Error as e:
+                    logger.error(f"Erro no checkpoint do SQLite: {e}")
+        finally:
+            conn.close()
+    
+    def _checkpoint(self, conn):
+        started = time.perf_counter()
+        _, frames, _ = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        elapsed = time.perf_counter() - started
+        # O WAL não muda de tamanho sem commits novos; só conta checkpoints com trabalho
+        if frames > 0 and frames != self.wal_frames:
+            self.checkpoints += 1
+            self.last_checkpoint_ms = elapsed * 1000
+            db_compact_seconds.observe(elapsed)
+        self.wal_frames = frames
+    
+    def _create_schema(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                credits REAL NOT NULL DEFAULT 0,
+                created_at TEXT,
+                keys_redeemed INTEGER NOT NULL DEFAULT 0,
+                total_creations INTEGER NOT NULL DEFAULT 0,
+                last_activity TEXT,
+                extra TEXT
+            );
+            CREATE TABLE IF NOT EXISTS keys (
+                key TEXT PRIMARY KEY,
+                created_by TEXT,
+                created_at TEXT,
+                credits REAL NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0,
+                used_by TEXT,
+                used_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS chats (
+                channel_id TEXT PRIMARY KEY,
+                owner_id TEXT NOT NULL,
+                channel_name TEXT,
+                created_at TEXT,
+                extra TEXT
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                channel_id TEXT,
+                message_id TEXT,
+                description TEXT NOT NULL,
+                use_cache INTEGER NOT NULL DEFAULT 1,
+                cost REAL NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_keys_used_by ON keys(used_by);
+            CREATE INDEX IF NOT EXISTS idx_chats_owner ON chats(owner_id);
+            CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state);
+        """)
+    
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT, com rollback em caso de erro"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+    
+    def _get_meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row["value"] if row else None
+    
+    @staticmethod
+    def _row_to_dict(row, columns):
+        data = json.loads(row["extra"]) if row["extra"] else {}
+        data.update({column: row[column] for column in columns})
+        return data
+    
+    def _upsert_user(self, conn, user_id, user_data):
+        extra = {k: v for k, v in user_data.items() if k not in self.USER_COLUMNS}
+        conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, credits, created_at, keys_redeemed, total_creations, last_activity, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, user_data.get("credits", 0.0), user_data.get("created_at"), user_data.get("keys_redeemed", 0),
+             user_data.get("total_creations", 0), user_data.get("last_activity"), json.dumps(extra) if extra else None)
+        )
+    
+    def _insert_key(self, conn, key, key_data):
+        conn.execute(
+            "INSERT OR REPLACE INTO keys (key, created_by, created_at, credits, used, used_by, used_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, key_data.get("created_by"), key_data.get("created_at"), key_data["credits"],
+             int(bool(key_data.get("used"))), key_data.get("used_by"), key_data.get("used_at"))
+        )
+    
+    def _insert_chat(self, conn, channel_id, chat_data):
+        extra = {k: v for k, v in chat_data.items() if k not in self.CHAT_COLUMNS}
+        conn.execute(
+            "INSERT OR REPLACE INTO chats (channel_id, owner_id, channel_name, created_at, extra) VALUES (?, ?, ?, ?, ?)",
+            (channel_id, str(chat_data["owner_id"]), chat_data.get("channel_name"), chat_data.get("created_at"),
+             json.dumps(extra) if extra else None)
+        )
+    
+    def _insert_job(self, conn, job_id, job):
+        conn.execute(
+            f"INSERT OR REPLACE INTO jobs (job_id, {', '.join(self.JOB_COLUMNS)}) "
+            f"VALUES (?, {', '.join('?' for _ in self.JOB_COLUMNS)})",
+            (job_id, *(int(job[c]) if c == "use_cache" else job.get(c) for c in self.JOB_COLUMNS))
+        )
+    
+    def _job_from_row(self, row):
+        job = {column: row[column] for column in self.JOB_COLUMNS}
+        job["use_cache"] = bool(job["use_cache"])
+        return job
+    
+    def _credit_user(self, conn, user_id, amount):
+        now = datetime.now().isoformat()
+        conn.execute(
+            "INSERT INTO users (user_id, credits, created_at, keys_redeemed, total_creations, last_activity) "
+            "VALUES (?, 0, ?, 0, 0, ?) ON CONFLICT(user_id) DO NOTHING",
+            (user_id, now, now)
+        )
+        conn.execute(
+            "UPDATE users SET credits = ROUND(credits + ?, 2), keys_redeemed = keys_redeemed + 1, last_activity = ? "
+            "WHERE user_id = ?",
+            (amount, now, user_id)
+        )
+        return conn.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,)).fetchone()["credits"]
+    
+    def save_all(self):
+        self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    
+    def close(self):
+        if self.conn is None:
+            return
+        self._stop.set()
+        self._checkpoint_thread.join(timeout=5)
+        self.save_all()
+        self.conn.close()
+        self.conn = None
+    
+    def writer_stats(self) -> Dict[str, Any]:
+        # Commits são síncronos (WAL + synchronous=NORMAL, sem checkpoint automático: não há
+        # fsync no commit); o fsync fica no checkpoint, na thread
+        return {
+            "queue_depth": 0,
+            "checkpoints": self.checkpoints,
+            "last_checkpoint_ms": round(self.last_checkpoint_ms, 2),
+            "wal_frames": self.wal_frames
+        }
+    
+    def get_user(self, user_id):
+        row = self.conn.execute("SELECT * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return self._row_to_dict(row, self.USER_COLUMNS) if row else None
+    
+    def create_user(self, user_id):
+        user_data = {
+            "credits": 0.0,
+            "created_at": datetime.now().isoformat(),
+            "keys_redeemed": 0,
+            "total_creations": 0,
+            "last_activity": datetime.now().isoformat()
+        }
+        with self.transaction() as conn:
+            self._upsert_user(conn, str(user_id), user_data)
+        return user_data
+    
+    def add_credits(self, user_id, amount):
+        with self.transaction() as conn:
+            return self._credit_user(conn, str(user_id), amount)
+    
+    def deduct_credits(self, user_id, amount):
+        cursor = self.conn.execute(
+            "UPDATE users SET credits = ROUND(credits - ?, 2), total_creations = total_creations + 1, last_activity = ? "
+            "WHERE user_id = ? AND credits >= ?",
+            (amount, datetime.now().isoformat(), str(user_id), amount)
+        )
+        return cursor.rowcount == 1
+    
+    def create_key(self, key, created_by, credits):
+        with self.transaction() as conn:
+            self._insert_key(conn, key, {
+                "created_by": created_by,
+                "created_at": datetime.now().isoformat(),
+                "credits": credits,
+                "used": False
+            })
+        return True
+    
+    def _claim_key(self, conn, key, user_id):
+        cursor = conn.execute(
+            "UPDATE keys SET used = 1, used_by = ?, used_at = ? WHERE key = ? AND used = 0",
+            (user_id, datetime.now().isoformat(), key)
+        )
+        if cursor.rowcount != 1:
+            return None
+        return conn.execute("SELECT credits FROM keys WHERE key = ?", (key,)).fetchone()["credits"]
+    
+    def use_key(self, key, user_id):
+        with self.transaction() as conn:
+            return self._claim_key(conn, key, str(user_id))
+    
+    def redeem_key(self, key, user_id):
+        """Marca a key como usada e credita o usuário na mesma transação"""
+        user_id = str(user_id)
+        with self.transaction() as conn:
+            credits = self._claim_key(conn, key, user_id)
+            if credits is None:
+                return None
+            return credits, self._credit_user(conn, user_id, credits)
+    
+    def register_chat(self, channel_id, owner_id, channel_name):
+        with self.transaction() as conn:
+            self._insert_chat(conn, str(channel_id), {
+                "owner_id": owner_id,
+                "channel_name": channel_name,
+                "created_at": datetime.now().isoformat()
+            })
+    
+    def get_chat(self, channel_id):
+        row = self.conn.execute("SELECT * FROM chats WHERE channel_id = ?", (str(channel_id),)).fetchone()
+        return self._row_to_dict(row, self.CHAT_COLUMNS) if row else None
+    
+    def touch_chat(self, channel_id):
+        """Atualiza a última atividade do chat (guardada na coluna extra)"""
+        with self.transaction() as conn:
+            row = conn.execute("SELECT * FROM chats WHERE channel_id = ?", (str(channel_id),)).fetchone()
+            if row is None:
+                return False
+            chat_data = self._row_to_dict(row, self.CHAT_COLUMNS)
+            chat_data["last_activity"] = datetime.now().isoformat()
+            self._insert_chat(conn, str(channel_id), chat_data)
+        return True
+    
+    def get_owner_chats(self, owner_id):
+        """Canais registrados do usuário (índice idx_chats_owner)"""
+        rows = self.conn.execute("SELECT channel_id FROM chats WHERE owner_id = ?", (str(owner_id),)).fetchall()
+        return [row["channel_id"] for row in rows]
+    
+    def iter_chats(self):
+        rows = self.conn.execute("SELECT * FROM chats").fetchall()
+        return [(row["channel_id"], self._row_to_dict(row, self.CHAT_COLUMNS)) for row in rows]
+    
+    def count_users(self):
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    
+    def count_chats(self):
+        return self.conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+    
+    def remove_chat(self, channel_id):
+        cursor = self.conn.execute("DELETE FROM chats WHERE channel_id = ?", (str(channel_id),))
+        return cursor.rowcount == 1
+    
+    def enqueue_job(self, job_id, user_id, channel_id, message_id, description, use_cache, cost):
+        """Cobra os créditos e cria o job na mesma transação (None = saldo insuficiente)"""
+        now = datetime.now().isoformat()
+        job = {
+            "user_id": str(user_id),
+            "channel_id": str(channel_id),
+            "message_id": str(message_id) if message_id else None,
+            "description": description,
+            "use_cache": use_cache,
+            "cost": cost,
+            "state": JOB_QUEUED,
+            "attempts": 0,
+            "error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE users SET credits = ROUND(credits - ?, 2), total_creations = total_creations + 1, last_activity = ? "
+                "WHERE user_id = ? AND credits >= ?",
+                (cost, now, str(user_id), cost)
+            )
+            if cursor.rowcount != 1:
+                return None
+            self._insert_job(conn, job_id, job)
+        return job
+    
+    def get_job(self, job_id):
+        row = self.conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._job_from_row(row) if row else None
+    
+    def update_job(self, job_id, **fields):
+        fields = {k: v for k, v in fields.items() if k in self.JOB_COLUMNS}
+        fields["updated_at"] = datetime.now().isoformat()
+        if "use_cache" in fields:
+            fields["use_cache"] = int(fields["use_cache"])
+        cursor = self.conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE job_id = ?",
+            (*fields.values(), job_id)
+        )
+        return cursor.rowcount == 1
+    
+    def refund_job(self, job_id, error=None):
+        """Devolve os créditos de um job pendente e marca como reembolsado (retorna o novo saldo)"""
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT user_id, cost FROM jobs WHERE job_id = ? AND state IN (?, ?)",
+                (job_id, *JOB_PENDING_STATES)
+            ).fetchone()
+            if row is None:
+                return None
+            
+            conn.execute(
+                "INSERT INTO users (user_id, credits, created_at, keys_redeemed, total_creations, last_activity) "
+                "VALUES (?, 0, ?, 0, 0, ?) ON CONFLICT(user_id) DO NOTHING",
+                (row["user_id"], now, now)
+            )
+            conn.execute(
+                "UPDATE users SET credits = ROUND(credits + ?, 2), last_activity = ? WHERE user_id = ?",
+                (row["cost"], now, row["user_id"])
+            )
+            conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                (JOB_REFUNDED, error, now, job_id)
+            )
+            return conn.execute("SELECT credits FROM users WHERE user_id = ?", (row["user_id"],)).fetchone()["credits"]
+    
+    def pending_jobs(self):
+        """Jobs na fila ou em execução, do mais antigo para o mais novo"""
+        rows = self.conn.execute(
+            "SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY created_at", JOB_PENDING_STATES
+        ).fetchall()
+        return [(row["job_id"], self._job_from_row(row)) for row in rows]
+    
+    def prune_jobs(self, older_than):
+        """Remove jobs finalizados com updated_at anterior a `older_than` (ISO)"""
+        cursor = self.conn.execute(
+            "DELETE FROM jobs WHERE state NOT IN (?, ?) AND updated_at < ?", (*JOB_PENDING_STATES, older_than)
+        )
+        return cursor.rowcount
+
+def migrate_json_to_sqlite(sqlite_db: SQLiteDatabase, data_dir: str = "data"):
+    """Importa uma única vez os data/*.json (snapshot + journal) para o SQLite"""
+    tables = {}
+    for name in ("users", "keys", "chats", "jobs"):
+        filename = f"{data_dir}/{name}.json"
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                tables[name] = json.load(f)
+        except (OSError, ValueError):
+            tables[name] = {}
+    
+    journal_file = f"{data_dir}/journal.log"
+    Journal.replay(f"{journal_file}.1", tables)
+    Journal.replay(journal_file, tables)
+    
+    with sqlite_db.transaction() as conn:
+        for user_id, user_data in tables["users"].items():
+            sqlite_db._upsert_user(conn, user_id, user_data)
+        for key, key_data in tables["keys"].items():
+            sqlite_db._insert_key(conn, key, key_data)
+        for channel_id, chat_data in tables["chats"].items():
+            sqlite_db._insert_chat(conn, channel_id, chat_data)
+        for job_id, job in tables["jobs"].items():
+            sqlite_db._insert_job(conn, job_id, job)
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('migrated_from_json', ?)",
+            (datetime.now().isoformat(),)
+        )
+    
+    logger.info(
+        f"✅ Migração JSON → SQLite: {len(tables['users'])} usuários, "
+        f"{len(tables['keys'])} keys, {len(tables['chats'])} chats"
+    )
+
+def open_database():
+    """Abre o backend configurado em DB_BACKEND (json ou sqlite)"""
+    if DB_BACKEND == "sqlite":
+        return SQLiteDatabase(SQLITE_PATH)
+    return Database()
+
+db = open_database()
+startup.mark("banco")
+
+# ================= CACHE DE RESPOSTAS =================
+def normalize_prompt(text: str) -> str:
+    """Forma canônica de uma pergunta: casefold, sem acentos e com espaços colapsados"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(without_accents.split())
+
+# Palavras que apontam para algo já dito na conversa ("e isso?", "faz igual ao anterior")
+CONTEXT_REFERENCES = {
+    "isso", "isto", "esse", "essa", "esses", "essas", "este", "esta", "estes", "estas",
+    "disso", "nisso", "desse", "dessa", "deste", "desta", "nesse", "nessa", "neste", "nesta",
+    "aquilo", "aquele", "aquela", "ele", "ela", "eles", "elas", "dele", "dela", "nele", "nela",
+    "anterior", "acima", "antes", "mesmo", "mesma", "tambem", "outro", "outra", "continua",
+    "continue", "it", "this", "that"
+}
+
+def is_self_contained(text: str) -> bool:
+    """Pergunta que se entende sem o histórico do canal (pode vir do cache mesmo com histórico)"""
+    words = re.findall(r"[a-z0-9]+", normalize_prompt(text))
+    return len(words) >= 3 and not CONTEXT_REFERENCES.intersection(words)
+
+class ResponseCache:
+    """Cache LRU + TTL de respostas da IA, limitado em entradas e em caracteres"""
+    def __init__(self, filename: Optional[str], ttl: float, max_entries: int, max_chars: int):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # chave -> (resposta, criado_em)
+        self._chars = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        # O arquivo é lido depois do boot (load); até lá o cache só não acerta
+        self.loaded = not filename
+    
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        response, created_at = entry
+        if time.time() - created_at > self.ttl:
+            self._remove(key)
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+    
+    def put(self, key: str, response: str, created_at: Optional[float] = None):
+        size = len(key) + len(response)
+        if size > self.max_chars:
+            return
+        
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (response, created_at or time.time())
+        self._chars += size
+        
+        while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+    
+    def _remove(self, key: str):
+        response, _ = self._entries.pop(key)
+        self._chars -= len(key) + len(response)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def snapshot(self) -> str:
+        """Serializa as entradas válidas (chamar no loop; a escrita pode ir para uma thread)"""
+        now = time.time()
+        entries = [[key, response, created_at] for key, (response, created_at) in self._entries.items()
+                   if now - created_at <= self.ttl]
+        return json.dumps(entries, ensure_ascii=False)
+    
+    def _read(self) -> List[tuple]:
+        if not os.path.exists(self.filename):
+            return []
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                return [(key, response, created_at) for key, response, created_at in json.load(f)]
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cache {self.filename} ignorado: {e}")
+            return []
+    
+    async def load(self):
+        """Lê o arquivo numa thread; o que já entrou desde o boot continua mais recente"""
+        entries = await asyncio.to_thread(self._read)
+        fresh = list(self._entries)
+        for key, response, created_at in entries:
+            if key not in self._entries and time.time() - created_at <= self.ttl:
+                self.put(key, response, created_at)
+        for key in fresh:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        self.loaded = True
+    
+    async def persist(self):
+        # Antes do load, gravar apagaria o que ainda não foi lido
+        if self.filename and self.loaded:
+            await asyncio.to_thread(write_file_atomic, self.filename, self.snapshot())
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "chars": self._chars,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+# Palavras que não ajudam a distinguir um sistema de outro
+SIMILARITY_STOPWORDS = {
+    "a", "o", "as", "os", "um", "uma", "de", "do", "da", "dos", "das", "em", "no", "na", "nos", "nas",
+    "com", "para", "pra", "por", "que", "e", "ou", "se", "ao", "sistema", "roblox", "script", "quero",
+    "faca", "crie", "criar", "um", "me", "meu", "minha", "the", "and", "with", "for"
+}
+
+def similarity_terms(text: str) -> Counter:
+    """Termos de uma descrição: normalizados, sem stopwords e com sufixos cortados (radical simples)"""
+    words = re.findall(r"[a-z0-9]+", normalize_prompt(text))
+    return Counter(word[:6] for word in words if word not in SIMILARITY_STOPWORDS and len(word) > 1)
+
+class SystemCache:
+    """Índice TF-IDF local de sistemas já gerados, para reaproveitar pedidos quase iguais
+    
+    Usa um índice invertido (termo -> entradas) para só comparar com descrições que
+    compartilham algum termo. Entradas expiram por idade e as mais antigas saem quando
+    o limite de tamanho é atingido.
+    """
+    def __init__(self, filename: Optional[str], threshold: float, max_entries: int, max_age: float):
+        self.filename = filename
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_age = max_age
+        
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()  # id -> {description, terms, result, created_at}
+        self._index: Dict[str, set] = {}
+        self._next_id = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        # O arquivo é lido depois do boot (load); até lá o cache só não acerta
+        self.loaded = not filename
+    
+    def _idf(self, term: str) -> float:
+        df = len(self._index.get(term, ()))
+        return math.log((1 + len(self._entries)) / (1 + df)) + 1
+    
+    def _vector(self, terms: Counter) -> Dict[str, float]:
+        vector = {term: count * self._idf(term) for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {term: weight / norm for term, weight in vector.items()} if norm else {}
+    
+    def _expire(self):
+        cutoff = time.time() - self.max_age
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if entry["created_at"] >= cutoff and len(self._entries) <= self.max_entries:
+                break
+            self._remove(entry_id)
+            self.evictions += 1
+    
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for term in entry["terms"]:
+            ids = self._index.get(term)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._index[term]
+    
+    def lookup(self, description: str) -> Optional[tuple]:
+        """Retorna (resultado, similaridade) do sistema mais parecido acima do limiar"""
+        self._expire()
+        terms = similarity_terms(description)
+        query = self._vector(terms)
+        
+        candidates = set()
+        for term in query:
+            candidates.update(self._index.get(term, ()))
+        
+        best_id, best_score = None, 0.0
+        for entry_id in candidates:
+            vector = self._vector(self._entries[entry_id]["terms"])
+            score = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+            if score > best_score:
+                best_id, best_score = entry_id, score
+        
+        if best_id is None or best_score < self.threshold:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        return self._entries[best_id]["result"], best_score
+    
+    def add(self, description: str, result: Dict[str, Any], created_at: Optional[float] = None,
+            terms: Optional[Counter] = None):
+        terms = terms if terms is not None else similarity_terms(description)
+        if not terms:
+            return
+        
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = {
+            "description": description,
+            "terms": terms,
+            "result": result,
+            "created_at": created_at or time.time()
+        }
+        for term in terms:
+            self._index.setdefault(term, set()).add(entry_id)
+        self._expire()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def snapshot(self) -> str:
+        entries = [
+            {"description": entry["description"], "result": entry["result"], "created_at": entry["created_at"]}
+            for entry in self._entries.values()
+        ]
+        return json.dumps(entries, ensure_ascii=False)
+    
+    def _read(self) -> List[tuple]:
+        """Lê o arquivo e já calcula os termos (a parte cara) fora do loop"""
+        if not os.path.exists(self.filename):
+            return []
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                return [
+                    (entry["description"], similarity_terms(entry["description"]), entry["result"], entry["created_at"])
+                    for entry in json.load(f)
+                ]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Cache {self.filename} ignorado: {e}")
+            return []
+    
+    async def load(self):
+        entries = await asyncio.to_thread(self._read)
+        fresh = list(self._entries)
+        for description, terms, result, created_at in entries:
+            self.add(description, result, created_at, terms=terms)
+        # Mantém a ordem por idade que o _expire espera
+        for entry_id in fresh:
+            if entry_id in self._entries:
+                self._entries.move_to_end(entry_id)
+        self.loaded = True
+    
+    async def persist(self):
+        # Antes do load, gravar apagaria o que ainda não foi lido
+        if self.filename and self.loaded:
+            await asyncio.to_thread(write_file_atomic, self.filename, self.snapshot())
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "terms": len(self._index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+# ================= MEMÓRIA DE CONVERSA =================
+class ConversationStore:
+    """Memória por canal: últimos turnos dentro de um orçamento de tokens + resumo acumulado
+    
+    Quando os turnos passam de CONVERSATION_TOKEN_BUDGET, os mais antigos são resumidos
+    numa task em segundo plano (fora do caminho da resposta). Canais ociosos saem da
+    memória para data/conversations/<canal>.json e voltam no próximo uso.
+    """
+    def __init__(self, directory: str, summarize: Callable):
+        self.directory = directory
+        self.summarize = summarize
+        os.makedirs(directory, exist_ok=True)
+        
+        self._active: Dict[str, Dict] = {}  # canal -> {"summary", "turns", "tokens", "last_active"}
+        self._compacting: Dict[str, asyncio.Task] = {}
+        
+        self.summaries = 0
+        self.evicted = 0
+    
+    def _path(self, channel_id: str) -> str:
+        return os.path.join(self.directory, f"{channel_id}.json")
+    
+    def _read(self, channel_id: str) -> Dict:
+        try:
+            with open(self._path(channel_id), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        turns = deque(data.get("turns", []))
+        return {
+            "summary": data.get("summary", ""),
+            "turns": turns,
+            "tokens": sum(estimate_tokens(turn["content"]) for turn in turns),
+            "last_active": time.monotonic()
+        }
+    
+    async def _get(self, channel_id: str) -> Dict:
+        channel_id = str(channel_id)
+        conversation = self._active.get(channel_id)
+        if conversation is None:
+            conversation = await asyncio.to_thread(self._read, channel_id)
+            # Outra mensagem pode ter carregado o canal enquanto líamos
+            conversation = self._active.setdefault(channel_id, conversation)
+        conversation["last_active"] = time.monotonic()
+        return conversation
+    
+    async def context(self, channel_id: str) -> List[Dict]:
+        """Mensagens de contexto para o prompt: resumo (se houver) + turnos recentes"""
+        conversation = await self._get(channel_id)
+        messages = []
+        if conversation["summary"]:
+            messages.append({"role": "system", "content": f"Resumo da conversa até aqui: {conversation['summary']}"})
+        messages.extend(conversation["turns"])
+        return messages
+    
+    async def add_exchange(self, channel_id: str, user_message: str, reply: str):
+        """Guarda pergunta e resposta; dispara a compactação se passou do orçamento"""
+        channel_id = str(channel_id)
+        conversation = await self._get(channel_id)
+        for role, content in (("user", user_message), ("assistant", reply)):
+            # Um script colado inteiro não deve ser reenviado a cada mensagem
+            content = truncate_to_tokens(content, CONVERSATION_MAX_TURN_TOKENS)
+            conversation["turns"].append({"role": role, "content": content})
+            conversation["tokens"] += estimate_tokens(content)
+        
+        # Limite rígido enquanto o resumo não fica pronto
+        while conversation["tokens"] > 2 * CONVERSATION_TOKEN_BUDGET and len(conversation["turns"]) > 2:
+            dropped = conversation["turns"].popleft()
+            conversation["tokens"] -= estimate_tokens(dropped["content"])
+        
+        if conversation["tokens"] > CONVERSATION_TOKEN_BUDGET and channel_id not in self._compacting:
+            task = asyncio.create_task(self._compact(channel_id, conversation))
+            self._compacting[channel_id] = task
+            task.add_done_callback(lambda _: self._compacting.pop(channel_id, None))
+    
+    async def _compact(self, channel_id: str, conversation: Dict):
+        """Resume os turnos mais antigos até os restantes caberem em metade do orçamento"""
+        turns = conversation["turns"]
+        old_turns = []
+        old_tokens = 0
+        for turn in turns:
+            if conversation["tokens"] - old_tokens <= CONVERSATION_TOKEN_BUDGET // 2:
+                break
+            old_turns.append(turn)
+            old_tokens += estimate_tokens(turn["content"])
+        
+        # Não separa uma pergunta da sua resposta
+        while old_turns and len(old_turns) < len(turns) and turns[len(old_turns)]["role"] != "user":
+            old_turns.append(turns[len(old_turns)])
+            old_tokens += estimate_tokens(old_turns[-1]["content"])
+        
+        if not old_turns:
+            return
+        
+        try:
+            summary = await self.summarize(conversation["summary"], old_turns)
+        except Exception as e:
+            logger.error(f"Erro ao resumir conversa {channel_id}: {e}")
+            summary = None
+        
+        # Remove os turnos resumidos que ainda estão no início (o limite rígido pode ter tirado alguns)
+        while turns and any(turns[0] is turn for turn in old_turns):
+            turns.popleft()
+        conversation["tokens"] = sum(estimate_tokens(turn["content"]) for turn in turns)
+        if summary:
+            conversation["summary"] = truncate_to_tokens(summary, CONVERSATION_SUMMARY_TOKENS)
+            self.summaries += 1
+    
+    def forget(self, channel_id: str):
+        """Apaga a memória de um canal (canal removido)"""
+        channel_id = str(channel_id)
+        self._active.pop(channel_id, None)
+        try:
+            os.remove(self._path(channel_id))
+        except OSError:
+            pass
+    
+    async def export(self, channel_id: str) -> Dict:
+        """Resumo e turnos do canal (da memória ou do disco), para arquivar"""
+        channel_id = str(channel_id)
+        conversation = self._active.get(channel_id) or await asyncio.to_thread(self._read, channel_id)
+        return {"summary": conversation["summary"], "turns": list(conversation["turns"])}
+    
+    def _write(self, channel_id: str, payload: str):
+        write_file_atomic(self._path(channel_id), payload)
+    
+    def _serialize(self, conversation: Dict) -> str:
+        return json.dumps({"summary": conversation["summary"], "turns": list(conversation["turns"])}, ensure_ascii=False)
+    
+    async def evict_idle(self, max_idle: float) -> int:
+        """Grava em disco e tira da memória os canais sem atividade há mais de max_idle segundos"""
+        cutoff = time.monotonic() - max_idle
+        idle = [cid for cid, conv in self._active.items() if conv["last_active"] < cutoff and cid not in self._compacting]
+        evicted = 0
+        for channel_id in idle:
+            conversation = self._active.get(channel_id)
+            if conversation is None or conversation["last_active"] >= cutoff:
+                continue
+            # Grava antes de tirar da memória: uma mensagem durante a escrita ainda acha a
+            # conversa em _active, em vez de recarregar o arquivo antigo do disco
+            await asyncio.to_thread(self._write, channel_id, self._serialize(conversation))
+            if self._active.get(channel_id) is not conversation:
+                # forget() durante a escrita: o arquivo recriado não deve ficar
+                self.forget(channel_id)
+                continue
+            if conversation["last_active"] < cutoff and channel_id not in self._compacting:
+                del self._active[channel_id]
+                evicted += 1
+        self.evicted += evicted
+        return evicted
+    
+    async def persist_all(self):
+        for channel_id, conversation in list(self._active.items()):
+            await asyncio.to_thread(self._write, channel_id, self._serialize(conversation))
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_channels": len(self._active),
+            "active_tokens": sum(conv["tokens"] for conv in self._active.values()),
+            "compacting": len(self._compacting),
+            "summaries": self.summaries,
+            "evicted": self.evicted
+        }
+
+# ================= FILA DE REQUISIÇÕES DA IA =================
+LANE_CREATION = 0  # criações pagas: sempre atendidas antes
+LANE_CHAT = 1      # conversa grátis
+LANE_NAMES = {LANE_CREATION: "creation", LANE_CHAT: "chat"}
+
+class LLMScheduler:
+    """Fila global das chamadas à IA
+    
+    Limita as requisições simultâneas, atende a faixa de criação antes da de chat e,
+    dentro de cada faixa, faz rodízio entre usuários para que um só não ocupe a fila.
+    """
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        # Uma fila por faixa: usuário -> deque de futures, na ordem do rodízio
+        self._lanes: List["OrderedDict[str, deque]"] = [OrderedDict(), OrderedDict()]
+        
+        self.granted = 0
+        self.max_wait = 0.0
+    
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for lane in self._lanes for queue in lane.values())
+    
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[str], lane: int = LANE_CHAT):
+        """Espera a vez do usuário e ocupa uma vaga enquanto o bloco roda"""
+        user_id = str(user_id)
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            self.in_flight += 1
+            self.granted += 1
+        else:
+            started = time.monotonic()
+            future = asyncio.get_running_loop().create_future()
+            self._lanes[lane].setdefault(user_id, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # A vaga chegou junto com o cancelamento: devolve
+                    self._release()
+                else:
+                    self._discard(lane, user_id, future)
+                raise
+            self.max_wait = max(self.max_wait, time.monotonic() - started)
+        
+        try:
+            yield
+        finally:
+            self._release()
+    
+    def _discard(self, lane: int, user_id: str, future: asyncio.Future):
+        queue = self._lanes[lane].get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._lanes[lane][user_id]
+    
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+    
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            future = self._next_waiter()
+            if future is None:
+                return
+            self.in_flight += 1
+            self.granted += 1
+            future.set_result(None)
+    
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for lane in self._lanes:
+            while lane:
+                user_id, queue = next(iter(lane.items()))
+                future = queue.popleft()
+                if queue:
+                    lane.move_to_end(user_id)
+                else:
+                    del lane[user_id]
+                if not future.done():
+                    return future
+        return None
+    
+    def position(self, user_id: str, lane: int) -> int:
+        """Posição (1 = próximo) do primeiro pedido do usuário na fila; 0 se não está esperando"""
+        user_id = str(user_id)
+        if user_id not in self._lanes[lane]:
+            return 0
+        ahead = sum(len(queue) for higher in self._lanes[:lane] for queue in higher.values())
+        # No rodízio, o primeiro pedido de cada usuário sai na primeira volta, na ordem da faixa
+        return ahead + list(self._lanes[lane]).index(user_id) + 1
+    
+    def estimate_position(self, user_id: str, lane: int) -> int:
+        """Posição que um novo pedido do usuário teria se entrasse agora (0 = atendido na hora)"""
+        user_id = str(user_id)
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            return 0
+        ahead = sum(len(queue) for higher in self._lanes[:lane] for queue in higher.values())
+        own = len(self._lanes[lane].get(user_id, ()))
+        # O novo pedido sai na volta `own` do rodízio
+        ahead += sum(min(len(queue), own + 1) for other, queue in self._lanes[lane].items() if other != user_id)
+        return ahead + own + 1
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting_creation": sum(len(queue) for queue in self._lanes[LANE_CREATION].values()),
+            "waiting_chat": sum(len(queue) for queue in self._lanes[LANE_CHAT].values()),
+            "granted": self.granted,
+            "max_wait_s": round(self.max_wait, 2)
+        }
+
+# ================= LIMITE DE TAXA =================
+class RateLimiter:
+    """Token buckets por (usuário, comando) e (servidor, comando), só em memória
+    
+    Cada bucket é [tokens, último uso, já avisado]. Os buckets ficam num OrderedDict em
+    ordem de uso; os do começo que já teriam enchido de novo são descartados, porque um
+    bucket cheio é igual a não ter bucket.
+    """
+    def __init__(self, user_limits: str, guild_limits: str, max_buckets: int):
+        self.limits = {"user": self.parse(user_limits), "guild": self.parse(guild_limits)}
+        self.max_buckets = max_buckets
+        self._buckets: OrderedDict = OrderedDict()
+        
+        self.allowed = 0
+        self.rejected: Counter = Counter()   # "escopo:comando" -> rejeições
+    
+    @staticmethod
+    def parse(spec: str) -> Dict[str, tuple]:
+        """"chat=6/30,default=10/30" -> {"chat": (6, 0.2), ...} (capacidade, tokens por segundo)"""
+        limits = {}
+        for item in spec.split(","):
+            if "=" not in item:
+                continue
+            command, _, rate = item.partition("=")
+            try:
+                burst, _, seconds = rate.partition("/")
+                burst, seconds = float(burst), float(seconds or 1)
+            except ValueError:
+                logger.warning(f"Limite de taxa inválido ignorado: {item!r}")
+                continue
+            if burst > 0 and seconds > 0:
+                limits[command.strip()] = (burst, burst / seconds)
+        return limits
+    
+    def _limit(self, scope: str, command: str) -> Optional[tuple]:
+        limits = self.limits[scope]
+        return limits.get(command) or limits.get("default")
+    
+    def _bucket(self, key: tuple, limit: tuple, now: float) -> list:
+        capacity, rate = limit
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now, False]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        return bucket
+    
+    def _evict(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            limit = self._limit(key[0], key[2])
+            idle_to_full = (limit[0] - bucket[0]) / limit[1] if limit else 0
+            if len(self._buckets) <= self.max_buckets and now - bucket[1] < idle_to_full:
+                break
+            del self._buckets[key]
+    
+    def hit(self, command: str, user_id, guild_id=None) -> tuple:
+        """Consome um token do usuário e do servidor para o comando
+        
+        Retorna (segundos para tentar de novo, primeira rejeição da sequência);
+        (0.0, False) quando liberado.
+        """
+        now = time.monotonic()
+        checks = []
+        for scope, owner in (("user", user_id), ("guild", guild_id)):
+            limit = self._limit(scope, command) if owner is not None else None
+            if limit:
+                checks.append((scope, limit, self._bucket((scope, str(owner), command), limit, now)))
+        
+        retry_after = 0.0
+        for scope, (capacity, rate), bucket in checks:
+            if bucket[0] < 1:
+                retry_after = max(retry_after, (1 - bucket[0]) / rate)
+                self.rejected[f"{scope}:{command}"] += 1
+        
+        first_rejection = False
+        if retry_after:
+            for _, _, bucket in checks:
+                first_rejection = first_rejection or not bucket[2]
+                bucket[2] = True
+        else:
+            for _, _, bucket in checks:
+                bucket[0] -= 1
+                bucket[2] = False
+            self.allowed += 1
+        
+        self._evict(now)
+        return retry_after, first_rejection
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buckets": len(self._buckets),
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected)
+        }
+
+rate_limiter = RateLimiter(RATE_LIMITS, GUILD_RATE_LIMITS, RATE_LIMIT_MAX_BUCKETS)
+
+def slow_down_embed(retry_after: float) -> discord.Embed:
+    return create_embed(
+        "🐢 Calma aí!",
+        f"Você está indo rápido demais. Tente de novo em **{math.ceil(retry_after)}s**.",
+        COLORS["warning"]
+    )
+
+# ================= ORÇAMENTO DE TOKENS =================
+# Janela de contexto conhecida de cada modelo (os demais usam o número no nome ou 8192)
+MODEL_CONTEXT_WINDOWS = {
+    "llama3-70b-8192": 8192,
+    "llama3-8b-8192": 8192,
+    "mixtral-8x7b-32768": 32768,
+    "gemma-7b-it": 8192,
+    "gemma2-9b-it": 8192
+}
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text: str) -> int:
+    """Estimativa local de tokens: pré-tokeniza como um BPE e conta ~4 caracteres por token de palavra"""
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PATTERN.findall(text or ""))
+
+def estimate_messages_tokens(messages: List[Dict]) -> int:
+    # ~4 tokens de formatação por mensagem do chat
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages) + 2
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Corta o texto no último trecho que cabe em max_tokens"""
+    total = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        total += (len(match.group()) + 3) // 4
+        if total > max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+def model_context_window(model: str) -> int:
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+    match = re.search(r'-(\d{4,6})$', model)
+    return int(match.group(1)) if match else 8192
+
+def fit_max_tokens(model: str, messages: List[Dict], requested: int) -> Optional[int]:
+    """max_tokens que cabe na janela do modelo junto com a entrada; None se não cabe o mínimo"""
+    available = model_context_window(model) - estimate_messages_tokens(messages) - TOKEN_SAFETY_MARGIN
+    if available < MIN_OUTPUT_TOKENS:
+        return None
+    return min(requested, available)
+
+class TokenUsage:
+    """Tokens de entrada/saída por comando (reais quando a API informa `usage`, senão estimados)"""
+    def __init__(self):
+        self.by_command: Dict[str, Dict[str, int]] = {}
+    
+    def record(self, command: str, input_tokens: int, output_tokens: int, estimated: bool = False):
+        counters = self.by_command.setdefault(command, {
+            "requests": 0, "input_tokens": 0, "output_tokens": 0, "estimated_requests": 0
+        })
+        counters["requests"] += 1
+        counters["input_tokens"] += input_tokens
+        counters["output_tokens"] += output_tokens
+        if estimated:
+            counters["estimated_requests"] += 1
+    
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {command: dict(counters) for command, counters in self.by_command.items()}
+
+# ================= ROTEADOR DE MODELOS =================
+def parse_duration(value: str) -> Optional[float]:
+    """Converte durações da Groq ("7.66s", "2m59.56s", "1h2m", "500ms") em segundos"""
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value or "")
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Segundos até poder tentar de novo, a partir de Retry-After ou x-ratelimit-reset-*"""
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    
+    resets = [parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+class ModelStats:
+    """Estado de saúde de um modelo: latência média móvel, erros recentes e cooldown
+    
+    A latência tem uma média por modo: "stream" mede até o primeiro token e "full" a
+    resposta inteira; misturar as duas faria o último modelo usado em stream parecer
+    dezenas de vezes mais rápido.
+    """
+    def __init__(self):
+        self.latency_ms: Dict[str, Optional[float]] = {"stream": None, "full": None}
+        self.outcomes = deque(maxlen=ROUTER_WINDOW)  # True = sucesso
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.cooldown_reason = ""
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.requests = 0
+        self.rate_limits = 0
+        self.last_status = ""
+        self.last_success_at: Optional[float] = None
+    
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+    
+    def cooldown_remaining(self) -> float:
+        return max(0.0, self.cooldown_until - time.monotonic())
+
+class ModelRouter:
+    """Escolhe o modelo mais rápido entre os saudáveis e respeita os limites da Groq
+    
+    429 coloca o modelo em cooldown pelo tempo de Retry-After / x-ratelimit-reset-*;
+    ROUTER_BREAKER_FAILURES falhas seguidas abrem o disjuntor por ROUTER_BREAKER_COOLDOWN.
+    """
+    def __init__(self, models: List[str]):
+        self.models = list(models)
+        self.stats = {model: ModelStats() for model in self.models}
+    
+    def _score(self, model: str, mode: str) -> float:
+        stats = self.stats[model]
+        latency_ms = stats.latency_ms[mode]
+        if latency_ms is None:
+            # Ainda sem medição neste modo: experimenta antes dos demais
+            return 0.0
+        return latency_ms * (1 + 2 * stats.error_rate)
+    
+    def pick(self, exclude=(), mode: str = "full") -> Optional[str]:
+        """Modelo saudável com melhor pontuação no modo (stream/full), ignorando os já tentados"""
+        healthy = [m for m in self.models if m not in exclude and self.stats[m].cooldown_remaining() == 0]
+        if not healthy:
+            return None
+        return min(healthy, key=lambda model: self._score(model, mode))
+    
+    def _update_limits(self, stats: ModelStats, headers) -> Optional[float]:
+        """Lê x-ratelimit-remaining-*; retorna o cooldown se alguma cota chegou a zero"""
+        if not headers:
+            return None
+        for name, attr in (("x-ratelimit-remaining-requests", "remaining_requests"),
+                           ("x-ratelimit-remaining-tokens", "remaining_tokens")):
+            value = headers.get(name)
+            if value is not None and value.isdigit():
+                setattr(stats, attr, int(value))
+        
+        if stats.remaining_requests == 0 or stats.remaining_tokens == 0:
+            return parse_retry_after(headers)
+        return None
+    
+    def _cooldown(self, stats: ModelStats, seconds: float, reason: str):
+        stats.cooldown_until = max(stats.cooldown_until, time.monotonic() + seconds)
+        stats.cooldown_reason = reason
+    
+    def record_latency(self, model: str, latency_ms: float, mode: str = "full"):
+        stats = self.stats[model]
+        current = stats.latency_ms[mode]
+        if current is None:
+            stats.latency_ms[mode] = latency_ms
+        else:
+            stats.latency_ms[mode] = current + ROUTER_EWMA_ALPHA * (latency_ms - current)
+    
+    def record_success(self, model: str, latency_ms: Optional[float] = None, headers=None):
+        stats = self.stats[model]
+        stats.requests += 1
+        stats.outcomes.append(True)
+        stats.consecutive_failures = 0
+        stats.last_status = "200"
+        stats.last_success_at = time.time()
+        if latency_ms is not None:
+            self.record_latency(model, latency_ms)
+        
+        exhausted = self._update_limits(stats, headers)
+        if exhausted:
+            self._cooldown(stats, exhausted, "cota esgotada")
+    
+    def record_rate_limit(self, model: str, headers) -> float:
+        stats = self.stats[model]
+        stats.requests += 1
+        stats.rate_limits += 1
+        stats.last_status = "429"
+        self._update_limits(stats, headers)
+        cooldown = parse_retry_after(headers) or ROUTER_DEFAULT_COOLDOWN
+        self._cooldown(stats, cooldown, "429")
+        return cooldown
+    
+    def record_failure(self, model: str, reason: str, headers=None):
+        stats = self.stats[model]
+        stats.requests += 1
+        stats.outcomes.append(False)
+        stats.consecutive_failures += 1
+        stats.last_status = reason
+        self._update_limits(stats, headers)
+        
+        if stats.consecutive_failures >= ROUTER_BREAKER_FAILURES:
+            self._cooldown(stats, ROUTER_BREAKER_COOLDOWN, "disjuntor aberto")
+    
+    def backoff(self, attempt: int) -> float:
+        """Espera antes de uma nova tentativa: até o primeiro modelo sair do cooldown"""
+        soonest = min(stats.cooldown_remaining() for stats in self.stats.values())
+        base = 2 ** attempt
+        return min(max(soonest, base), ROUTER_MAX_BACKOFF)
+    
+    def last_success_at(self) -> Optional[float]:
+        times = [stats.last_success_at for stats in self.stats.values() if stats.last_success_at]
+        return max(times) if times else None
+    
+    def snapshot(self) -> Dict[str, Any]:
+        result = {}
+        for model, stats in self.stats.items():
+            remaining = stats.cooldown_remaining()
+            result[model] = {
+                "state": stats.cooldown_reason if remaining else "healthy",
+                "cooldown_remaining_s": round(remaining, 1),
+                "first_token_ms": round(stats.latency_ms["stream"], 1) if stats.latency_ms["stream"] is not None else None,
+                "latency_ms": round(stats.latency_ms["full"], 1) if stats.latency_ms["full"] is not None else None,
+                "error_rate": round(stats.error_rate, 3),
+                "consecutive_failures": stats.consecutive_failures,
+                "remaining_requests": stats.remaining_requests,
+                "remaining_tokens": stats.remaining_tokens,
+                "requests": stats.requests,
+                "rate_limits": stats.rate_limits,
+                "last_status": stats.last_status
+            }
+        return result
+
+# ================= PARSER DAS RESPOSTAS =================
+DEFAULT_INSTALLATION_GUIDE = """📁 **PASSO A PASSO PARA INSTALAR NO ROBLOX STUDIO:**
+
+1. **ABRA SEU JOGO** no Roblox Studio
+2. **CRIE AS PASTAS** conforme estrutura abaixo:
+   - ServerScriptService/Sistema/
+   - StarterPack/Sistema/
+   - ReplicatedStorage/SharedModules/ (se necessário)
+
+3. **PARA CADA ARQUIVO GERADO:**
+   - Clique com botão direito na pasta correta
+   - Selecione "Insert Object" → Escolha o tipo (Script, LocalScript ou ModuleScript)
+   - Renomeie para o nome do arquivo
+   - Clique duas vezes no script e cole o código correspondente
+
+4. **TESTE:**
+   - Primeiro em "Play Solo" (modo local)
+   - Depois publique e teste online
+   - Verifique o Output para erros"""
+
+class RobloxResponseParser:
+    """Parser incremental (máquina de estados, uma passada) das respostas de criação
     
-    def _load_json(self, filename):
-        if os.path.exists(filename):
-            try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
+    Recebe o texto em pedaços com feed(), que devolve os arquivos prontos: cada seção
+    "=== ARQUIVO n: caminho ===" é emitida assim que o primeiro bloco ``` dela fecha,
+    ou quando a seção termina se não houver bloco. O guia de instalação é capturado na
+    mesma passada. Sem cabeçalhos de arquivo, os blocos ``` soltos viram arquivos no close().
+    """
+    HEADER_PATTERN = re.compile(
+        r'===+\s*ARQUIVO\s*\d+:\s*([\w\/\-\.]+\.(?:server\.lua|client\.lua|lua))\s*===+', re.IGNORECASE
+    )
+    # Em ordem de preferência, como no extrator antigo
+    GUIDE_KEYWORDS = ("instruções", "instalação", "como instalar", "roblox studio")
     
-    def _save_json(self, filename, data):
-        try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            logger.error(f"Erro ao salvar {filename}: {e}")
+    def __init__(self, path_resolver: Callable[[str], str]):
+        self.path_resolver = path_resolver
+        self.blocks: List[Dict[str, str]] = []
+        
+        self._pending = ""            # última linha ainda incompleta
+        self._seen_header = False
+        self._generic: List[str] = []  # blocos ``` fora de seções (fallback)
+        
+        # Seção de arquivo atual
+        self._filename: Optional[str] = None
+        self._raw: List[str] = []
+        self._emitted = False
+        
+        # Bloco ``` aberto
+        self._in_fence = False
+        self._fence: List[str] = []
+        
+        # Guia: palavra-chave -> linhas capturadas; as que terminaram saem de _capturing
+        self._guides: Dict[str, List[str]] = {}
+        self._capturing: set = set()
     
-    def save_all(self):
-        self._save_json(self.users_file, self.users)
-        self._save_json(self.keys_file, self.keys)
-        self._save_json(self.chats_file, self.chats)
+    def feed(self, chunk: str) -> List[Dict[str, str]]:
+        """Processa mais texto; retorna os arquivos que ficaram completos"""
+        before = len(self.blocks)
+        lines = (self._pending + chunk).split("\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self._line(line)
+        return self.blocks[before:]
     
-    def get_user(self, user_id):
-        return self.users.get(str(user_id))
+    def close(self) -> List[Dict[str, str]]:
+        """Fim da resposta: fecha a seção aberta e aplica o fallback de blocos soltos"""
+        before = len(self.blocks)
+        if self._pending:
+            self._line(self._pending)
+            self._pending = ""
+        self._end_section()
+        
+        if not self._seen_header:
+            for i, code in enumerate(self._generic):
+                if code:
+                    self.blocks.append({
+                        "filename": f"Sistema_{i+1}.server.lua",
+                        "code": code,
+                        "type": "Script",
+                        "path": "ServerScriptService/Sistema"
+                    })
+        return self.blocks[before:]
     
-    def create_user(self, user_id):
-        user_data = {
-            "credits": 0.0,
-            "created_at": datetime.now().isoformat(),
-            "keys_redeemed": 0,
-            "total_creations": 0,
-            "last_activity": datetime.now().isoformat()
-        }
-        self.users[str(user_id)] = user_data
-        self.save_all()
-        return user_data
+    @property
+    def guide(self) -> str:
+        for keyword in self.GUIDE_KEYWORDS:
+            guide = "\n".join(self._guides.get(keyword, ())).strip()
+            if len(guide) > 50:
+                return guide
+        return DEFAULT_INSTALLATION_GUIDE
     
-    def add_credits(self, user_id, amount):
-        user_id = str(user_id)
-        if user_id not in self.users:
-            self.create_user(user_id)
+    def _line(self, line: str):
+        self._capture_guide(line)
         
-        user = self.users[user_id]
-        user["credits"] = round(user.get("credits", 0) + amount, 2)
-        user["keys_redeemed"] = user.get("keys_redeemed", 0) + 1
-        user["last_activity"] = datetime.now().isoformat()
-        self.save_all()
-        return user["credits"]
+        if "ARQUIVO" in line.upper():
+            match = self.HEADER_PATTERN.search(line)
+            if match:
+                if match.start():
+                    # O que vem antes do cabeçalho ainda é da seção anterior
+                    self._content(line[:match.start()])
+                self._end_section()
+                self._seen_header = True
+                self._filename = match.group(1).strip()
+                line = line[match.end():]
+        
+        self._content(line)
     
-    def deduct_credits(self, user_id, amount):
-        user = self.get_user(user_id)
-        if not user or user["credits"] < amount:
-            return False
+    def _content(self, line: str):
+        if self._filename is None:
+            if not self._seen_header:
+                self._generic.extend(self._scan_fences(line))
+            return
         
-        user["credits"] = round(user["credits"] - amount, 2)
-        user["total_creations"] = user.get("total_creations", 0) + 1
-        user["last_activity"] = datetime.now().isoformat()
-        self.save_all()
-        return True
+        self._raw.append(line)
+        if not self._emitted:
+            closed = self._scan_fences(line)
+            if closed:
+                self._emit(closed[0])
     
-    def create_key(self, key, created_by, credits):
-        self.keys[key] = {
-            "created_by": created_by,
-            "created_at": datetime.now().isoformat(),
-            "credits": credits,
-            "used": False
-        }
-        self.save_all()
-        return True
+    def _scan_fences(self, line: str) -> List[str]:
+        """Avança o estado dos blocos ``` com uma linha; retorna o código dos blocos que fecharam nela"""
+        closed = []
+        while True:
+            if not self._in_fence:
+                pos = line.find("```")
+                if pos < 0:
+                    return closed
+                line = line[pos + 3:]
+                for tag in ("luau", "lua"):
+                    if line.startswith(tag):
+                        line = line[len(tag):]
+                        break
+                self._in_fence = True
+                self._fence = []
+            
+            pos = line.find("```")
+            if pos < 0:
+                self._fence.append(line)
+                return closed
+            
+            self._fence.append(line[:pos])
+            self._in_fence = False
+            closed.append("\n".join(self._fence).strip())
+            # O resto da linha pode abrir outro bloco ("``` e ```lua")
+            line = line[pos + 3:]
     
-    def use_key(self, key, user_id):
-        if key in self.keys and not self.keys[key]["used"]:
-            credits = self.keys[key]["credits"]
-            self.keys[key]["used"] = True
-            self.keys[key]["used_by"] = str(user_id)
-            self.keys[key]["used_at"] = datetime.now().isoformat()
-            self.save_all()
-            return credits
-        return None
+    def _end_section(self):
+        if self._filename is not None and not self._emitted:
+            # Sem bloco ``` fechado: usa a seção inteira, como o extrator antigo
+            self._emit("\n".join(self._raw).strip())
+        self._filename = None
+        self._raw = []
+        self._emitted = False
+        self._in_fence = False
     
-    def register_chat(self, channel_id, owner_id, channel_name):
-        self.chats[str(channel_id)] = {
-            "owner_id": owner_id,
-            "channel_name": channel_name,
-            "created_at": datetime.now().isoformat()
-        }
-        self.save_all()
-
-db = Database()
+    def _emit(self, code: str):
+        self._emitted = True
+        if not code or len(code) <= 10:
+            return
+        
+        filename = self._filename
+        # Determina o tipo de script pelo nome do arquivo
+        script_type = "Script"
+        if filename.endswith('.client.lua'):
+            script_type = "LocalScript"
+        elif filename.endswith('.server.lua'):
+            script_type = "Script"
+        elif filename.endswith('.lua') and 'module' in filename.lower():
+            script_type = "ModuleScript"
+        
+        self.blocks.append({
+            "filename": filename,
+            "code": code,
+            "type": script_type,
+            "path": self.path_resolver(filename)
+        })
+    
+    def _capture_guide(self, line: str):
+        for keyword in list(self._capturing):
+            captured = self._guides[keyword]
+            if line.startswith("==="):
+                self._capturing.discard(keyword)
+            elif not line.strip():
+                # Linhas vazias logo após o título são puladas; depois, terminam o guia
+                if captured:
+                    self._capturing.discard(keyword)
+            else:
+                captured.append(line)
+        
+        if len(self._guides) == len(self.GUIDE_KEYWORDS):
+            return
+        lowered = line.lower()
+        for keyword in self.GUIDE_KEYWORDS:
+            if keyword in self._guides:
+                continue
+            pos = lowered.find(keyword)
+            if pos >= 0:
+                rest = line[pos + len(keyword):].lstrip(": \t")
+                self._guides[keyword] = [rest] if rest else []
+                self._capturing.add(keyword)
 
 # ================= IA GROQ ESPECIALISTA EM ROBLOX =================
 class PolarDevAI:
@@ -186,6 +2428,38 @@ class PolarDevAI:
         self.api_key = api_key
         self.base_url = "https://api.groq.com/openai/v1/chat/completions"
         self.timeout = 60
+        # Criações geram milhares de tokens de uma vez: limite próprio, conexão ainda em 60s
+        self.creation_timeout = aiohttp.ClientTimeout(total=LLM_CREATION_TIMEOUT or None, sock_connect=self.timeout)
+        
+        # Modelos gratuitos da Groq, escolhidos pelo roteador conforme a saúde de cada um
+        self.models = GROQ_MODELS
+        self.router = ModelRouter(self.models)
+        self.token_usage = TokenUsage()
+        
+        # Respostas de chat já geradas, pela pergunta normalizada
+        self.response_cache = ResponseCache(
+            RESPONSE_CACHE_FILE if RESPONSE_CACHE_PERSIST else None,
+            ttl=RESPONSE_CACHE_TTL,
+            max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            max_chars=RESPONSE_CACHE_MAX_CHARS
+        )
+        
+        # Sistemas já gerados, para pedidos quase idênticos
+        self.system_cache = SystemCache(
+            SYSTEM_CACHE_FILE,
+            threshold=SYSTEM_CACHE_THRESHOLD,
+            max_entries=SYSTEM_CACHE_MAX_ENTRIES,
+            max_age=SYSTEM_CACHE_MAX_AGE
+        )
+        
+        # Memória por canal de chat, com resumo em segundo plano
+        self.conversations = ConversationStore(CONVERSATIONS_DIR, summarize=self.summarize_turns)
+        
+        # Fila global: limite de simultâneas, prioridade e rodízio por usuário
+        self.scheduler = LLMScheduler(LLM_MAX_IN_FLIGHT)
+        
+        # Sessão HTTP com pool keep-alive, criada no primeiro uso (precisa do loop rodando)
+        self._session: Optional[aiohttp.ClientSession] = None
         
         # Prompt especializado para Roblox Luau
         self.system_prompt = """Você é PolarDev, especialista sênior em desenvolvimento Roblox Lua/Luau com 10+ anos de experiência.
@@ -224,156 +2498,350 @@ INSTRUÇÕES DE INSTALAÇÃO:
 Passo a passo para Roblox Studio
 
 Sempre use ```lua para blocos de código."""
+        
+        # Variante curta para o chat: sem o formato de arquivos das criações.
+        # Os dois prompts são fixos e vêm primeiro, para o prefixo poder ser
+        # reaproveitado pelo cache de prompt do provedor.
+        self.chat_system_prompt = """Você é PolarDev, especialista sênior em Roblox Lua/Luau (Script, LocalScript, ModuleScript, DataStores, RemoteEvents, UI, performance e anti-exploit).
+Responda de forma amigável, clara e prática, com exemplos curtos. Use ```lua para blocos de código."""
 
-    async def make_request(self, messages: List[Dict], max_tokens: int = 4000) -> Optional[str]:
-        """Faz requisição para Groq API"""
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Retorna a sessão compartilhada, reaproveitando conexões TCP/TLS entre chamadas"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_PER_HOST_LIMIT,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self._session
+    
+    async def load_caches(self):
+        """Carrega os caches persistidos depois do boot, sem atrasar o READY"""
         try:
-            # Modelos gratuitos da Groq
-            available_models = [
-                "llama3-70b-8192",
-                "mixtral-8x7b-32768",
-                "gemma-7b-it"
-            ]
-            
-            payload = {
-                "model": random.choice(available_models),
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": max_tokens,
-                "stream": False
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None, 
-                lambda: requests.post(
-                    self.base_url, 
-                    headers=headers, 
-                    json=payload, 
-                    timeout=self.timeout
-                )
+            await asyncio.gather(self.response_cache.load(), self.system_cache.load())
+            logger.info(f"✅ Caches carregados: {len(self.response_cache)} respostas, {len(self.system_cache)} sistemas")
+        except Exception as e:
+            logger.error(f"Erro ao carregar caches: {e}")
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        await self.response_cache.persist()
+        await self.system_cache.persist()
+        await self.conversations.persist_all()
+    
+    def _payload(self, model: str, messages: List[Dict], max_tokens: int, stream: bool) -> Dict[str, Any]:
+        return {
+            "model": model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+    
+    async def _handle_error(self, model: str, response: aiohttp.ClientResponse) -> bool:
+        """Registra a falha no roteador; retorna True se vale tentar outro modelo"""
+        error_text = (await response.text())[:200]
+        if response.status == 429:
+            cooldown = self.router.record_rate_limit(model, response.headers)
+            logger.warning(f"Rate limit da Groq em {model} ({cooldown:.0f}s), tentando outro modelo...")
+            return True
+        
+        logger.error(f"Groq Error {response.status} ({model}): {error_text}")
+        self.router.record_failure(model, f"HTTP {response.status}", response.headers)
+        # 401/402/403 valem para a conta inteira: trocar de modelo não resolve
+        return response.status not in (401, 402, 403)
+    
+    def _record_usage(self, command: str, messages: List[Dict], content: str, usage: Optional[Dict]):
+        if usage and "prompt_tokens" in usage:
+            self.token_usage.record(command, usage["prompt_tokens"], usage.get("completion_tokens", 0))
+        else:
+            self.token_usage.record(command, estimate_messages_tokens(messages), estimate_tokens(content), estimated=True)
+    
+    async def make_request_stream(self, messages: List[Dict], max_tokens: int = 1500,
+                                  state: Optional[Dict] = None, user_id: Optional[str] = None,
+                                  lane: int = LANE_CHAT, command: str = "chat") -> AsyncIterator[str]:
+        """Faz requisição em modo stream (SSE), produzindo os trechos de texto conforme chegam
+        
+        Troca de modelo enquanto nenhum trecho foi entregue. Se `state` for passado,
+        recebe state["done"] = True quando o stream termina com [DONE].
+        """
+        # Sem limite total: o timeout vale para o intervalo entre trechos
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.timeout)
+        tried = set()
+        
+        queued_at = time.perf_counter()
+        async with self.scheduler.slot(user_id, lane):
+            llm_queue_wait_seconds.observe(time.perf_counter() - queued_at, lane=LANE_NAMES[lane])
+            while True:
+                model = self.router.pick(exclude=tried, mode="stream")
+                if model is None:
+                    logger.warning("Nenhum modelo Groq disponível para o stream")
+                    return
+                tried.add(model)
+                
+                model_max_tokens = fit_max_tokens(model, messages, max_tokens)
+                if model_max_tokens is None:
+                    logger.warning(f"Entrada grande demais para {model}, tentando outro modelo...")
+                    continue
+                
+                started = time.monotonic()
+                yielded = False
+                parts = []
+                usage = None
+                try:
+                    async with self._get_session().post(
+                        self.base_url, json=self._payload(model, messages, model_max_tokens, True), timeout=timeout
+                    ) as response:
+                        if response.status != 200:
+                            llm_attempt_seconds.observe(time.monotonic() - started, model=model, status=response.status)
+                            if await self._handle_error(model, response):
+                                continue
+                            return
+                        
+                        async for raw_line in response.content:
+                            line = raw_line.decode('utf-8').strip()
+                            if not line.startswith("data:"):
+                                continue
+                            
+                            data = line[5:].strip()
+                            if data == "[DONE]":
+                                self.router.record_success(model, headers=response.headers)
+                                self._record_usage(command, messages, "".join(parts), usage)
+                                if state is not None:
+                                    state["done"] = True
+                                return
+                            
+                            chunk = json.loads(data)
+                            # A Groq manda o uso real no último trecho (x_groq.usage)
+                            usage = chunk.get("x_groq", {}).get("usage") or chunk.get("usage") or usage
+                            delta = chunk["choices"][0].get("delta", {}).get("content") if chunk.get("choices") else None
+                            if delta:
+                                parts.append(delta)
+                                if not yielded:
+                                    # Para o stream, a latência medida é até o primeiro token
+                                    self.router.record_latency(model, (time.monotonic() - started) * 1000, mode="stream")
+                                    llm_attempt_seconds.observe(time.monotonic() - started, model=model, status=200)
+                                yielded = True
+                                yield delta
+                        
+                        self.router.record_failure(model, "stream interrompido")
+                        return
+                
+                except asyncio.TimeoutError:
+                    logger.warning(f"Timeout no stream Groq ({model})")
+                    self.router.record_failure(model, "timeout")
+                    llm_attempt_seconds.observe(time.monotonic() - started, model=model, status="timeout")
+                except aiohttp.ClientError as e:
+                    logger.error(f"Erro de conexão Groq (stream, {model}): {e}")
+                    self.router.record_failure(model, type(e).__name__)
+                    llm_attempt_seconds.observe(time.monotonic() - started, model=model, status="error")
+                except ValueError as e:
+                    logger.error(f"Evento SSE inválido da Groq ({model}): {e}")
+                    self.router.record_failure(model, "SSE inválido")
+                
+                if yielded:
+                    return
+    
+    async def make_request(self, messages: List[Dict], max_tokens: int = 4000,
+                           user_id: Optional[str] = None, lane: int = LANE_CHAT,
+                           command: str = "chat") -> Optional[str]:
+        """Faz requisição para Groq API (passando pela fila global)
+        
+        Usa o modelo mais rápido e saudável segundo o roteador e, em caso de 429,
+        erro de servidor ou timeout, tenta os demais modelos na mesma requisição.
+        max_tokens é um teto: cada modelo recebe o que cabe na sua janela de contexto.
+        """
+        started = time.perf_counter()
+        content = None
+        try:
+            content = await self._make_request(messages, max_tokens, user_id, lane, command)
+            return content
+        finally:
+            llm_call_seconds.observe(
+                time.perf_counter() - started, command=command, outcome="ok" if content else "failed"
             )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return data["choices"][0]["message"]["content"]
-            elif response.status_code == 429:
-                logger.warning("Rate limit da Groq, tentando outro modelo...")
-                await asyncio.sleep(2)
-                available_models.remove(payload["model"])
-                if available_models:
-                    payload["model"] = available_models[0]
+    
+    async def _make_request(self, messages: List[Dict], max_tokens: int, user_id: Optional[str],
+                            lane: int, command: str) -> Optional[str]:
+        tried = set()
+        
+        queued_at = time.perf_counter()
+        async with self.scheduler.slot(user_id, lane):
+            llm_queue_wait_seconds.observe(time.perf_counter() - queued_at, lane=LANE_NAMES[lane])
+            while True:
+                model = self.router.pick(exclude=tried)
+                if model is None:
+                    logger.warning("Nenhum modelo Groq disponível no momento")
                     return None
-                return None
-            else:
-                error_text = response.text[:200]
-                logger.error(f"Groq Error {response.status_code}: {error_text}")
-                return None
+                tried.add(model)
                 
-        except requests.Timeout:
-            logger.warning("Timeout na requisição Groq")
-            return None
-        except requests.RequestException as e:
-            logger.error(f"Erro de conexão Groq: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Erro inesperado Groq: {e}")
-            return None
+                model_max_tokens = fit_max_tokens(model, messages, max_tokens)
+                if model_max_tokens is None:
+                    logger.warning(f"Entrada grande demais para {model}, tentando outro modelo...")
+                    continue
+                
+                started = time.monotonic()
+                timeout = self.creation_timeout if lane == LANE_CREATION else aiohttp.ClientTimeout(total=self.timeout)
+                try:
+                    async with self._get_session().post(
+                        self.base_url, json=self._payload(model, messages, model_max_tokens, False), timeout=timeout
+                    ) as response:
+                        llm_attempt_seconds.observe(time.monotonic() - started, model=model, status=response.status)
+                        if response.status == 200:
+                            data = await response.json()
+                            self.router.record_success(model, (time.monotonic() - started) * 1000, response.headers)
+                            content = data["choices"][0]["message"]["content"]
+                            self._record_usage(command, messages, content, data.get("usage"))
+                            return content
+                        
+                        if not await self._handle_error(model, response):
+                            return None
+                
+                except asyncio.TimeoutError:
+                    logger.warning(f"Timeout na requisição Groq ({model})")
+                    self.router.record_failure(model, "timeout")
+                    llm_attempt_seconds.observe(time.monotonic() - started, model=model, status="timeout")
+                except aiohttp.ClientError as e:
+                    logger.error(f"Erro de conexão Groq ({model}): {e}")
+                    self.router.record_failure(model, type(e).__name__)
+                    llm_attempt_seconds.observe(time.monotonic() - started, model=model, status="error")
+                except Exception as e:
+                    logger.error(f"Erro inesperado Groq ({model}): {e}")
+                    self.router.record_failure(model, type(e).__name__)
     
-    async def generate_response(self, message: str) -> str:
-        """Gera resposta para conversas normais - Versão mais amigável"""
-        # Primeiro verifica se é saudação
+    def _greeting_reply(self, message: str) -> Optional[str]:
+        """Resposta fixa para saudações simples (não chama a API)"""
         greetings = ['ola', 'olá', 'oi', 'hey', 'hi', 'hello', 'eae', 'opa', 'fala']
         if message.lower() in greetings:
             return "Olá! 👋 Eu sou a PolarDev, especialista em desenvolvimento Roblox Lua/Luau! Como posso te ajudar hoje com Roblox Studio?"
+        return None
+    
+    def _chat_messages(self, message: str, history: Optional[List[Dict]] = None) -> List[Dict]:
+        messages = [{"role": "system", "content": self.chat_system_prompt}]
+        messages.extend(history or [])
         
         # Verifica se é pergunta sobre ModuleScript
         if 'modulescript' in message.lower() or 'module script' in message.lower():
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": f"Explique de forma clara e amigável o que é um ModuleScript no Roblox, para que serve, e dê um exemplo simples."}
-            ]
+            messages.append({"role": "user", "content": f"Explique de forma clara e amigável o que é um ModuleScript no Roblox, para que serve, e dê um exemplo simples."})
         else:
             # Resposta geral
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": f"Usuário perguntou: {message}\n\nResponda de forma amigável, útil e focada em desenvolvimento Roblox."}
-            ]
+            messages.append({"role": "user", "content": f"Usuário perguntou: {message}\n\nResponda de forma amigável, útil e focada em desenvolvimento Roblox."})
+        return messages
+    
+    async def _prepare_chat(self, message: str, channel_id: Optional[str]) -> tuple:
+        """Monta as mensagens com o histórico do canal e decide o uso do cache de respostas
+        
+        Retorna (mensagens, chave, gravar): perguntas que se entendem sozinhas consultam o
+        cache mesmo com histórico; só respostas geradas sem histórico entram nele, já que
+        as demais podem depender da conversa.
+        """
+        history = await self.conversations.context(channel_id) if channel_id else []
+        messages = self._chat_messages(message, history)
+        if history and not is_self_contained(message):
+            return messages, None, False
+        return messages, normalize_prompt(messages[-1]["content"]), not history
+    
+    async def summarize_turns(self, summary: str, turns: List[Dict]) -> Optional[str]:
+        """Resume turnos antigos de uma conversa junto com o resumo anterior"""
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        messages = [
+            {"role": "system", "content": "Resuma conversas técnicas sobre Roblox de forma curta, mantendo fatos, nomes de scripts e decisões."},
+            {"role": "user", "content": f"Resumo anterior: {summary or '(vazio)'}\n\nNovos trechos:\n{transcript}\n\nEscreva o resumo atualizado em até 8 linhas."}
+        ]
+        return await self.make_request(messages, max_tokens=CONVERSATION_SUMMARY_TOKENS, lane=LANE_CHAT, command="resumo")
+    
+    @staticmethod
+    def clean_response(response: str) -> str:
+        """Remove possíveis menções restritivas"""
+        response = response.replace("RECUSE QUALQUER PEDIDO", "Posso te ajudar")
+        response = response.replace("SÓ GERE CÓDIGO", "Especializado em")
+        return response
+    
+    async def generate_response(self, message: str, user_id: Optional[str] = None,
+                                channel_id: Optional[str] = None) -> str:
+        """Gera resposta para conversas normais - Versão mais amigável
+        
+        Com channel_id, usa e atualiza a memória de conversa do canal.
+        """
+        # Primeiro verifica se é saudação
+        greeting = self._greeting_reply(message)
+        if greeting:
+            return greeting
+        
+        messages, cache_key, store = await self._prepare_chat(message, channel_id)
+        cached = self.response_cache.get(cache_key) if cache_key else None
+        if cached:
+            if channel_id:
+                await self.conversations.add_exchange(channel_id, message, cached)
+            return cached
         
         for attempt in range(3):
-            response = await self.make_request(messages, max_tokens=1500)
+            response = await self.make_request(messages, max_tokens=1500, user_id=user_id, lane=LANE_CHAT)
             if response:
-                # Remove possíveis menções restritivas
-                response = response.replace("RECUSE QUALQUER PEDIDO", "Posso te ajudar")
-                response = response.replace("SÓ GERE CÓDIGO", "Especializado em")
+                response = self.clean_response(response)
+                if store:
+                    self.response_cache.put(cache_key, response)
+                if channel_id:
+                    await self.conversations.add_exchange(channel_id, message, response)
                 return response
             
             if attempt < 2:
-                wait_time = (attempt + 1) * 2
-                await asyncio.sleep(wait_time)
+                await asyncio.sleep(self.router.backoff(attempt))
         
         return "🤖 Olá! Sou a PolarDev, especialista em Roblox. Posso te ajudar com:\n• Dúvidas sobre Lua/Luau\n• Criação de sistemas Roblox\n• Otimização de scripts\n• E muito mais! 😊"
     
-    def extract_roblox_code_blocks(self, text: str) -> List[Dict[str, str]]:
-        """Extrai múltiplos blocos de código Roblox da resposta"""
-        code_blocks = []
+    async def generate_response_stream(self, message: str, user_id: Optional[str] = None,
+                                       channel_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Versão em stream do generate_response: produz o texto conforme a IA gera"""
+        greeting = self._greeting_reply(message)
+        if greeting:
+            yield greeting
+            return
         
-        # Procura por padrões de arquivos Roblox
-        file_pattern = r'===+\s*ARQUIVO\s*\d+:\s*([\w\/\-\.]+\.(?:server\.lua|client\.lua|lua))\s*===+'
-        file_matches = list(re.finditer(file_pattern, text, re.IGNORECASE))
+        messages, cache_key, store = await self._prepare_chat(message, channel_id)
+        cached = self.response_cache.get(cache_key) if cache_key else None
+        if cached:
+            if channel_id:
+                await self.conversations.add_exchange(channel_id, message, cached)
+            yield cached
+            return
         
-        if file_matches:
-            for i, match in enumerate(file_matches):
-                filename = match.group(1).strip()
-                start_pos = match.end()
-                
-                if i < len(file_matches) - 1:
-                    end_pos = file_matches[i + 1].start()
-                    code = text[start_pos:end_pos].strip()
-                else:
-                    code = text[start_pos:].strip()
-                
-                # Extrai o código entre ```lua ``` se existir
-                code_match = re.search(r'```(?:lua|luau)?\s*(.*?)\s*```', code, re.DOTALL)
-                if code_match:
-                    code = code_match.group(1).strip()
-                
-                if code and len(code) > 10:
-                    # Determina o tipo de script pelo nome do arquivo
-                    script_type = "Script"
-                    if filename.endswith('.client.lua'):
-                        script_type = "LocalScript"
-                    elif filename.endswith('.server.lua'):
-                        script_type = "Script"
-                    elif filename.endswith('.lua') and 'module' in filename.lower():
-                        script_type = "ModuleScript"
-                    
-                    code_blocks.append({
-                        "filename": filename,
-                        "code": code,
-                        "type": script_type,
-                        "path": self.determine_roblox_path(filename)
-                    })
-        else:
-            # Tenta extrair blocos de código genéricos
-            generic_blocks = re.findall(r'```(?:lua|luau)?\s*(.*?)\s*```', text, re.DOTALL)
-            for i, block in enumerate(generic_blocks):
-                if block.strip():
-                    code_blocks.append({
-                        "filename": f"Sistema_{i+1}.server.lua",
-                        "code": block.strip(),
-                        "type": "Script",
-                        "path": "ServerScriptService/Sistema"
-                    })
+        parts = []
+        state = {}
+        async for delta in self.make_request_stream(messages, max_tokens=1500, state=state, user_id=user_id):
+            parts.append(delta)
+            yield delta
         
-        return code_blocks
+        if parts:
+            response = self.clean_response("".join(parts))
+            if state.get("done") and store:
+                self.response_cache.put(cache_key, response)
+            if channel_id:
+                await self.conversations.add_exchange(channel_id, message, response)
+        else:
+            # O stream falhou antes do primeiro token: usa o caminho com novas tentativas
+            yield await self.generate_response(message, user_id=user_id, channel_id=channel_id)
+    
+    def parse_response(self, text: str) -> "RobloxResponseParser":
+        """Analisa uma resposta completa numa única passada (arquivos + guia)"""
+        parser = RobloxResponseParser(self.determine_roblox_path)
+        parser.feed(text)
+        parser.close()
+        return parser
+    
+    def extract_roblox_code_blocks(self, text: str) -> List[Dict[str, str]]:
+        """Extrai múltiplos blocos de código Roblox da resposta"""
+        return self.parse_response(text).blocks
     
-    def determine_roblox_path(self, filename: str) -> str:
+    @staticmethod
+    def determine_roblox_path(filename: str) -> str:
         """Determina o caminho correto no Roblox Studio"""
         filename_lower = filename.lower()
         
@@ -394,42 +2862,28 @@ Sempre use ```lua para blocos de código."""
     
     def extract_installation_guide(self, text: str) -> str:
         """Extrai guia de instalação para Roblox Studio"""
-        guide_patterns = [
-            r'INSTRUÇÕES[:\s]*\n?(.*?)(?=\n\n|\n===|$)',
-            r'INSTALAÇÃO[:\s]*\n?(.*?)(?=\n\n|\n===|$)',
-            r'COMO INSTALAR[:\s]*\n?(.*?)(?=\n\n|\n===|$)',
-            r'ROBLOX STUDIO[:\s]*\n?(.*?)(?=\n\n|\n===|$)'
-        ]
+        return self.parse_response(text).guide
+    
+    async def create_roblox_system(self, description: str, use_cache: bool = True,
+                                   user_id: Optional[str] = None) -> Dict[str, Any]:
+        """Cria um sistema Roblox completo
         
-        for pattern in guide_patterns:
-            match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
-            if match:
-                guide = match.group(1).strip()
-                if len(guide) > 50:
-                    return guide
+        Com use_cache, um sistema já gerado para uma descrição parecida é reaproveitado.
+        """
+        if use_cache:
+            cached = self.system_cache.lookup(description)
+            if cached:
+                result, similarity = cached
+                logger.info(f"Sistema reaproveitado do cache (similaridade {similarity:.2f})")
+                return {**result, "cached": True, "similarity": similarity}
         
-        # Guia padrão
-        return """📁 **PASSO A PASSO PARA INSTALAR NO ROBLOX STUDIO:**
-
-1. **ABRA SEU JOGO** no Roblox Studio
-2. **CRIE AS PASTAS** conforme estrutura abaixo:
-   - ServerScriptService/Sistema/
-   - StarterPack/Sistema/
-   - ReplicatedStorage/SharedModules/ (se necessário)
-
-3. **PARA CADA ARQUIVO GERADO:**
-   - Clique com botão direito na pasta correta
-   - Selecione "Insert Object" → Escolha o tipo (Script, LocalScript ou ModuleScript)
-   - Renomeie para o nome do arquivo
-   - Clique duas vezes no script e cole o código correspondente
-
-4. **TESTE:**
-   - Primeiro em "Play Solo" (modo local)
-   - Depois publique e teste online
-   - Verifique o Output para erros"""
+        result = await self._generate_roblox_system(description, user_id)
+        if result["success"]:
+            # A resposta bruta não é usada na entrega; guarda só o que foi extraído
+            self.system_cache.add(description, {k: v for k, v in result.items() if k != "full_response"})
+        return result
     
-    async def create_roblox_system(self, description: str) -> Dict[str, Any]:
-        """Cria um sistema Roblox completo"""
+    async def _generate_roblox_system(self, description: str, user_id: Optional[str]) -> Dict[str, Any]:
         prompt = f"""CRIE UM SISTEMA COMPLETO DE ROBLOX LUA/LUAU BASEADO NA DESCRIÇÃO:
 
 {description}
@@ -462,17 +2916,19 @@ Dicas específicas para otimizar este sistema."""
         ]
         
         for attempt in range(3):
-            response = await self.make_request(messages, max_tokens=6000)
+            response = await self.make_request(
+                messages, max_tokens=6000, user_id=user_id, lane=LANE_CREATION, command="criar_sistema"
+            )
             
             if response:
-                code_blocks = self.extract_roblox_code_blocks(response)
+                parsed = self.parse_response(response)
                 
-                if code_blocks:
+                if parsed.blocks:
                     return {
                         "success": True,
                         "full_response": response,
-                        "code_blocks": code_blocks,
-                        "instructions": self.extract_installation_guide(response)
+                        "code_blocks": parsed.blocks,
+                        "instructions": parsed.guide
                     }
                 else:
                     return {
@@ -484,12 +2940,12 @@ Dicas específicas para otimizar este sistema."""
                             "type": "Script",
                             "path": "ServerScriptService/Sistema"
                         }],
-                        "instructions": self.extract_installation_guide(response)
+                        "instructions": parsed.guide
                     }
             
             if attempt < 2:
-                wait_time = (attempt + 1) * 4
-                logger.info(f"Tentativa {attempt + 1} falhou, aguardando {wait_time}s...")
+                wait_time = self.router.backoff(attempt)
+                logger.info(f"Tentativa {attempt + 1} falhou, aguardando {wait_time:.1f}s...")
                 await asyncio.sleep(wait_time)
         
         return {
@@ -498,28 +2954,105 @@ Dicas específicas para otimizar este sistema."""
         }
 
 ai = PolarDevAI(GROQ_API_KEY)
+startup.mark("ia")
 
 # ================= BOT SETUP =================
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
+class PolarDevTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        """Limite de taxa dos slash commands, antes de tocar no banco ou na IA"""
+        if interaction.command is None:
+            return True
+        interaction.extras["started_at"] = time.perf_counter()
+        retry_after, _ = rate_limiter.hit(interaction.command.name, interaction.user.id, interaction.guild_id)
+        if retry_after:
+            await interaction.response.send_message(embed=slow_down_embed(retry_after), ephemeral=True)
+            # Com False o discord.py só marca command_failed, sem on_error: a métrica sai daqui
+            observe_command(interaction, "rate_limited")
+            return False
+        return True
+    
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        observe_command(interaction, "error")
+        await super().on_error(interaction, error)
+
+def observe_command(interaction: discord.Interaction, outcome: str):
+    started_at = interaction.extras.get("started_at")
+    if started_at is not None and interaction.command is not None:
+        command_seconds.observe(time.perf_counter() - started_at, command=interaction.command.name, outcome=outcome)
+
 class PolarDevBot(commands.Bot):
     def __init__(self):
         super().__init__(
             command_prefix="!",
             intents=intents,
-            help_command=None
+            help_command=None,
+            tree_cls=PolarDevTree
         )
         self.db = db
         self.ai = ai
     
-    async def setup_hook(self):
-        """Configuração inicial assíncrona"""
+    async def close(self):
+        """Fecha a conexão e drena a fila de gravação do banco fora do loop"""
+        await web_server.stop()
+        # O watchdog vive do heartbeat do monitor: para antes dele
+        loop_watchdog.stop()
+        health_monitor.stop()
+        await creation_jobs.stop()
+        await super().close()
+        await self.ai.close()
+        await asyncio.to_thread(self.db.close)
+    
+    def command_tree_hash(self) -> str:
+        """Hash do que o Discord recebe no sync (inclui o application_id, que muda com o token)"""
+        commands = sorted((command.to_dict(self.tree) for command in self.tree.get_commands()),
+                          key=lambda command: command["name"])
+        payload = json.dumps({"application_id": self.application_id, "commands": commands},
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    async def sync_commands(self):
+        """Só chama tree.sync() (lento e com rate limit global) quando a árvore mudou"""
+        tree_hash = self.command_tree_hash()
+        try:
+            with open(COMMAND_TREE_HASH_FILE, 'r', encoding='utf-8') as f:
+                synced_hash = f.read().strip()
+        except OSError:
+            synced_hash = None
+        
+        if tree_hash == synced_hash and not FORCE_COMMAND_SYNC:
+            logger.info("✅ Comandos inalterados, sync pulado")
+            return
+        
         await self.tree.sync()
+        await asyncio.to_thread(write_file_atomic, COMMAND_TREE_HASH_FILE, tree_hash)
         logger.info("✅ Comandos sincronizados")
+    
+    async def setup_hook(self):
+        """Configuração inicial assíncrona"""
+        startup.mark("login")
+        # Sobe primeiro: o Render precisa da porta aberta enquanto os comandos sincronizam
+        await web_server.start()
+        startup.mark("servidor web")
+        await self.sync_commands()
+        startup.mark("comandos")
         
         self.loop.create_task(self.change_status())
+        self.loop.create_task(self.ai.load_caches())
+        persist_caches.start()
+        evict_idle_conversations.start()
+        await creation_jobs.start()
+        health_monitor.start()
+        if LOOP_WATCHDOG_ENABLED:
+            loop_watchdog.start()
+        if CHAT_EXPIRY_DAYS > 0:
+            for channel_id in chat_expiry.rebuild(db.iter_chats()):
+                db.touch_chat(channel_id)
+            expire_chats.start()
+        startup.mark("subsistemas")
     
     async def change_status(self):
         """Task para mudar status periodicamente"""
@@ -527,8 +3060,8 @@ class PolarDevBot(commands.Bot):
         
         statuses = [
             discord.Activity(type=discord.ActivityType.watching, name=f"/ajuda • Roblox Expert"),
-            discord.Activity(type=discord.ActivityType.playing, name=f"Roblox Studio • {len(db.users)} devs"),
-            discord.Activity(type=discord.ActivityType.listening, name=f"/criar_chat • {len(db.chats)} sistemas"),
+            discord.Activity(type=discord.ActivityType.playing, name=f"Roblox Studio • {db.count_users()} devs"),
+            discord.Activity(type=discord.ActivityType.listening, name=f"/criar_chat • {db.count_chats()} sistemas"),
             discord.Activity(type=discord.ActivityType.watching, name=f"Luau • Roblox Lua • Scripts")
         ]
         
@@ -537,7 +3070,302 @@ class PolarDevBot(commands.Bot):
                 await self.change_presence(activity=status, status=discord.Status.online)
                 await asyncio.sleep(60)
 
-bot = PolarDevBot()
+bot = PolarDevBot()
+
+# ================= SAÚDE DO BOT =================
+class HealthMonitor:
+    """Heartbeat no loop do bot: mede o atraso do loop e avalia a saúde a cada intervalo
+    
+    O heartbeat bate a cada `beat_interval` (é ele que o LoopWatchdog vigia) e a saúde é
+    reavaliada a cada `interval`, com o maior atraso visto na janela. O resultado fica num
+    snapshot trocado atomicamente; /health/live e /health/ready só leem esse snapshot,
+    então um probe nunca refaz a avaliação nem consulta o Discord.
+    """
+    def __init__(self, interval: float, beat_interval: float):
+        self.interval = interval
+        self.beat_interval = beat_interval
+        self.started_at = time.monotonic()
+        self.last_beat: Optional[float] = None
+        self.loop_lag_ms = 0.0
+        self.max_loop_lag_ms = 0.0
+        self._window_lag_ms = 0.0   # maior atraso desde a última avaliação
+        self.snapshot: Dict[str, Any] = {"ready": False, "checks": {}, "reason": "iniciando"}
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    async def _run(self):
+        evaluated_at = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.beat_interval
+            await asyncio.sleep(self.beat_interval)
+            now = time.monotonic()
+            self.loop_lag_ms = max(0.0, now - expected) * 1000
+            self.max_loop_lag_ms = max(self.max_loop_lag_ms, self.loop_lag_ms)
+            self._window_lag_ms = max(self._window_lag_ms, self.loop_lag_ms)
+            self.last_beat = now
+            if now - evaluated_at < self.interval:
+                continue
+            evaluated_at = now
+            try:
+                self.snapshot = self.evaluate()
+            except Exception as e:
+                logger.error(f"Erro ao avaliar a saúde: {e}")
+            self._window_lag_ms = 0.0
+    
+    def evaluate(self) -> Dict[str, Any]:
+        latency = bot.latency
+        gateway_connected = bot.is_ready() and not bot.is_closed() and math.isfinite(latency)
+        
+        models = ai.router.snapshot()
+        available = [model for model, stats in models.items() if stats["state"] == "healthy"]
+        last_success = ai.router.last_success_at()
+        backlog = db.writer_stats()["queue_depth"]
+        
+        checks = {
+            "gateway": gateway_connected,
+            "loop_lag": self._window_lag_ms <= HEALTH_MAX_LOOP_LAG_MS,
+            "llm": bool(available),
+            "db_writer": backlog <= HEALTH_MAX_DB_BACKLOG
+        }
+        return {
+            "ready": all(checks.values()),
+            "checks": checks,
+            "gateway": {
+                "connected": gateway_connected,
+                "latency_ms": round(latency * 1000, 1) if math.isfinite(latency) else None
+            },
+            "loop_lag_ms": round(self._window_lag_ms, 1),
+            "max_loop_lag_ms": round(self.max_loop_lag_ms, 1),
+            "llm": {
+                "available_models": available,
+                "last_success_at": datetime.fromtimestamp(last_success).isoformat() if last_success else None,
+                "last_success_age_s": round(time.time() - last_success, 1) if last_success else None,
+                "models": {model: stats["state"] for model, stats in models.items()}
+            },
+            "db_writer_backlog": backlog,
+            "evaluated_at": datetime.now().isoformat()
+        }
+    
+    def liveness(self) -> tuple:
+        """(vivo?, detalhes) do /health/live
+        
+        O probe é atendido no próprio loop, então responder já prova que o loop gira; se ele
+        travar, o probe fica sem resposta e o timeout do probe é a falha. Aqui só resta
+        conferir se a task do heartbeat continua rodando (antes do start conta como viva).
+        """
+        now = time.monotonic()
+        alive = self._task is None or not self._task.done()
+        return alive, {
+            "alive": alive,
+            "heartbeat_age_s": round(now - self.last_beat, 1) if self.last_beat is not None else None,
+            "loop_lag_ms": round(self.loop_lag_ms, 1),
+            "uptime_s": round(now - self.started_at, 1)
+        }
+    
+    def readiness(self) -> tuple:
+        """(pronto?, detalhes): último snapshot, desde que o heartbeat continue rodando"""
+        alive, _ = self.liveness()
+        snapshot = self.snapshot
+        ready = alive and snapshot["ready"]
+        return ready, dict(snapshot, ready=ready, heartbeat_running=alive)
+
+health_monitor = HealthMonitor(HEALTH_HEARTBEAT_INTERVAL, min(HEALTH_HEARTBEAT_INTERVAL, LOOP_LAG_THRESHOLD_MS / 2000))
+
+class LoopWatchdog:
+    """Thread que detecta o loop travado e captura a pilha de quem está bloqueando
+    
+    Não tem heartbeat próprio: compara o último batimento do HealthMonitor com o relógio
+    e, passado o limite, lê a pilha da thread do loop com sys._current_frames(). Com a
+    amostragem ligada, repete a leitura enquanto o travamento durar e guarda a pilha
+    mais frequente (a que de fato está segurando o loop).
+    """
+    def __init__(self, monitor: HealthMonitor, threshold_ms: float, sample_ms: float, max_captures: int):
+        self.monitor = monitor
+        self.threshold = threshold_ms / 1000
+        self.sample_interval = sample_ms / 1000
+        self.captures: deque = deque(maxlen=max_captures)
+        self.stalls = 0
+        self._started_at = time.monotonic()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._stop = Event()
+        self._running = False
+    
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = get_ident()
+        self._started_at = time.monotonic()
+        self._stop.clear()
+        self._running = True
+        Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+    
+    def stop(self):
+        self._running = False
+        self._stop.set()
+    
+    def _last_tick(self) -> float:
+        return self.monitor.last_beat or self._started_at
+    
+    def _lag(self) -> float:
+        return max(0.0, time.monotonic() - self._last_tick() - self.monitor.beat_interval)
+    
+    def _sample(self) -> Optional[tuple]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None
+        task = asyncio.current_task(self._loop)
+        stack = "".join(traceback.format_stack(frame))
+        return (task.get_name() if task else None, stack)
+    
+    def _watch(self):
+        poll = min(self.threshold / 2, self.sample_interval or self.threshold / 2)
+        while not self._stop.wait(poll):
+            if self._lag() < self.threshold:
+                continue
+            
+            # Loop travado: captura agora, amostra enquanto durar e registra quando soltar
+            tick = self._last_tick()
+            samples = Counter()
+            sample = self._sample()
+            if sample:
+                samples[sample] += 1
+            if self.sample_interval:
+                while not self._stop.wait(self.sample_interval) and self._last_tick() == tick:
+                    sample = self._sample()
+                    if sample:
+                        samples[sample] += 1
+            else:
+                while not self._stop.wait(poll) and self._last_tick() == tick:
+                    pass
+            self._record(tick, samples)
+    
+    def _record(self, tick: float, samples: Counter):
+        last_tick = self._last_tick()
+        lag_ms = max(0.0, (last_tick if last_tick != tick else time.monotonic())
+                          - tick - self.monitor.beat_interval) * 1000
+        self.stalls += 1
+        if not samples:
+            return
+        (task_name, stack), hits = samples.most_common(1)[0]
+        capture = {
+            "at": datetime.now().isoformat(),
+            "lag_ms": round(lag_ms, 1),
+            "task": task_name,
+            "samples": sum(samples.values()),
+            "hits": hits,
+            "stack": stack
+        }
+        self.captures.append(capture)
+        logger.warning(
+            f"Loop travado por {capture['lag_ms']}ms (task {task_name}, "
+            f"{hits}/{capture['samples']} amostras):\n{stack}"
+        )
+    
+    def stats(self) -> Dict[str, Any]:
+        # O atraso do loop em si fica no HealthMonitor (loop_lag_ms), medido uma vez só
+        return {
+            "enabled": self._running,
+            "stalls": self.stalls,
+            "captures": len(self.captures)
+        }
+
+loop_watchdog = LoopWatchdog(health_monitor, LOOP_LAG_THRESHOLD_MS, LOOP_WATCHDOG_SAMPLE_MS, LOOP_WATCHDOG_CAPTURES)
+
+# ================= SERVIDOR WEB =================
+def json_response(data: Dict[str, Any], status: int = 200) -> web.Response:
+    # Alguns stats trazem datetime; serializa como texto
+    return web.json_response(data, status=status, dumps=lambda obj: json.dumps(obj, default=str))
+
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="🤖 PolarDev Bot está online! | Status: ✅ Ativo")
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    gauges = []
+    for component, stats in (
+        ("db_writer", db.writer_stats()),
+        ("response_cache", ai.response_cache.stats()),
+        ("system_cache", ai.system_cache.stats()),
+        ("llm_scheduler", ai.scheduler.stats()),
+        ("conversations", ai.conversations.stats()),
+        ("creation_jobs", creation_jobs.stats()),
+        ("rate_limits", rate_limiter.stats()),
+        ("chat_debounce", chat_debouncer.stats()),
+        ("chat_categories", chat_categories.stats()),
+        ("chat_expiry", chat_expiry.stats()),
+        ("loop_watchdog", loop_watchdog.stats())
+    ):
+        gauges.extend(metrics.render_stats(component, stats))
+    gauges.extend(metrics.render_stats("model", ai.router.snapshot(), by_key=True))
+    gauges.extend(metrics.render_stats("token_usage", ai.token_usage.snapshot(), by_key=True))
+    return web.Response(
+        text=metrics.render(gauges),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def health_live(request: web.Request) -> web.Response:
+    alive, details = health_monitor.liveness()
+    return json_response(details, 200 if alive else 503)
+
+async def health_ready(request: web.Request) -> web.Response:
+    ready, details = health_monitor.readiness()
+    return json_response(details, 200 if ready else 503)
+
+async def health(request: web.Request) -> web.Response:
+    return json_response({
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "db_writer": db.writer_stats(),
+        "response_cache": ai.response_cache.stats(),
+        "system_cache": ai.system_cache.stats(),
+        "llm_scheduler": ai.scheduler.stats(),
+        "models": ai.router.snapshot(),
+        "token_usage": ai.token_usage.snapshot(),
+        "conversations": ai.conversations.stats(),
+        "creation_jobs": creation_jobs.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "chat_debounce": chat_debouncer.stats(),
+        "chat_categories": chat_categories.stats(),
+        "chat_expiry": chat_expiry.stats(),
+        "loop_watchdog": loop_watchdog.stats()
+    })
+
+class WebServer:
+    """Servidor HTTP do bot (keep-alive do Render, health checks e métricas)
+    
+    Roda no mesmo loop do PolarDevBot, sem thread própria: os handlers leem o estado do
+    bot sem disputar com o loop, e o desligamento acompanha bot.close(). Por isso, com o
+    loop travado nenhuma rota responde, nem o /health/live: o travamento aparece como
+    timeout do probe (e o LoopWatchdog registra a pilha).
+    """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.app.router.add_get("/", home)
+        self.app.router.add_get("/metrics", metrics_endpoint)
+        self.app.router.add_get("/health", health)
+        self.app.router.add_get("/health/live", health_live)
+        self.app.router.add_get("/health/ready", health_ready)
+        self._runner: Optional[web.AppRunner] = None
+    
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"✅ Servidor web iniciado em http://{self.host}:{self.port}")
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+web_server = WebServer(WEB_HOST, WEB_PORT)
 
 # ================= FUNÇÕES AUXILIARES =================
 def generate_key() -> str:
@@ -558,6 +3386,93 @@ def create_embed(title: str, description: str = "", color: int = COLORS["primary
     embed.set_footer(text="PolarDev • Especialista em Roblox Lua/Luau")
     return embed
 
+class StreamingReply:
+    """Mostra uma resposta em stream editando mensagens do Discord em lotes
+    
+    Edita no máximo a cada STREAM_EDIT_INTERVAL segundos (e só com STREAM_EDIT_MIN_CHARS
+    novos caracteres), para ficar dentro do limite de edições por canal do Discord.
+    Quando o texto passa de uma página, a mensagem atual é fechada e outra é enviada.
+    """
+    PAGE_SIZE = 1990
+    
+    def __init__(self, channel: discord.abc.Messageable, transform: Callable[[str], str] = lambda text: text,
+                 on_commit: Optional[Callable[[], None]] = None):
+        self.channel = channel
+        self.transform = transform
+        self.on_commit = on_commit   # chamado antes do primeiro texto de verdade aparecer
+        self.text = ""
+        self.messages: List[discord.Message] = []
+        self._rendered = ""
+        self._last_edit = 0.0
+    
+    async def start(self, queue_position: int = 0):
+        placeholder = "✍️ *PolarDev está digitando...*"
+        if queue_position:
+            placeholder = f"🕒 *Você é o {queue_position}º da fila, já te respondo...*"
+        self.messages.append(await self.channel.send(placeholder))
+        self._last_edit = time.monotonic()
+    
+    async def feed(self, delta: str):
+        self.text += delta
+        if time.monotonic() - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        if len(self.text) - len(self._rendered) < STREAM_EDIT_MIN_CHARS:
+            return
+        await self.flush()
+    
+    async def flush(self):
+        rendered = self.transform(self.text)
+        if not rendered.strip() or rendered == self._rendered:
+            return
+        
+        if not self._rendered and self.on_commit:
+            self.on_commit()
+        
+        pages = [rendered[i:i + self.PAGE_SIZE] for i in range(0, len(rendered), self.PAGE_SIZE)]
+        # Fecha as páginas já completas e abre mensagens novas para as seguintes
+        for index, page in enumerate(pages):
+            if index < len(self.messages) - 1:
+                continue
+            if index < len(self.messages):
+                await self.messages[index].edit(content=page)
+            else:
+                self.messages.append(await self.channel.send(page))
+        
+        self._rendered = rendered
+        self._last_edit = time.monotonic()
+    
+    async def run(self, stream: AsyncIterator[str], queue_position: int = 0) -> str:
+        """Consome o stream inteiro e garante a edição final"""
+        await self.start(queue_position)
+        try:
+            async for delta in stream:
+                await self.feed(delta)
+        except asyncio.CancelledError:
+            # Cancelada antes de mostrar texto: some com o "digitando..."
+            if not self._rendered:
+                for message in self.messages:
+                    try:
+                        await message.delete()
+                    except discord.HTTPException:
+                        pass
+            raise
+        await self.flush()
+        return self.text
+
+async def report_queue_position(message: discord.Message, embed: discord.Embed, user_id: str,
+                                lane: int, task: asyncio.Task):
+    """Mostra no embed a posição do usuário na fila da IA enquanto ele espera"""
+    last_position = 0
+    while not task.done():
+        position = ai.scheduler.position(user_id, lane)
+        if position != last_position:
+            embed.clear_fields()
+            if position:
+                embed.add_field(name="🕒 Fila", value=f"Você é o **{position}º** da fila", inline=False)
+            await message.edit(embed=embed)
+            last_position = position
+        await asyncio.sleep(QUEUE_POSITION_REFRESH)
+
 def has_role(member: discord.Member, role_name: str) -> bool:
     return any(role.name == role_name for role in member.roles)
 
@@ -567,6 +3482,734 @@ def is_ceo(member: discord.Member) -> bool:
 def is_support(member: discord.Member) -> bool:
     return has_role(member, SUPPORT_ROLE) or is_ceo(member)
 
+# ================= PACOTE DE EXPORTAÇÃO =================
+ROBLOX_SCRIPT_CLASSES = {"Script", "LocalScript", "ModuleScript"}
+
+def roblox_script_name(filename: str) -> str:
+    """Nome da instância no Studio: Sistema/Main.server.lua -> Main"""
+    name = os.path.basename(filename)
+    for suffix in (".server.lua", ".client.lua", ".module.lua", ".lua", ".luau"):
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)] or "Script"
+    return name or "Script"
+
+def _cdata(text: str) -> str:
+    # "]]>" não pode aparecer dentro de um bloco CDATA
+    return "<![CDATA[" + text.replace("]]>", "]]]]><![CDATA[>") + "]]>"
+
+def build_rbxmx(code_blocks: List[Dict[str, str]]) -> str:
+    """Modelo .rbxmx com as pastas de cada caminho e os scripts com a classe certa
+    
+    Serviços não podem existir dentro de um modelo, então o primeiro nível do
+    caminho vira uma Folder com o nome do serviço (ex.: ServerScriptService).
+    """
+    tree: Dict[str, Any] = {}
+    for block in code_blocks:
+        node = tree
+        for folder in filter(None, block["path"].split("/")):
+            node = node.setdefault(folder, {})
+        node.setdefault("__scripts__", []).append(block)
+    
+    referents = iter(range(1, 1_000_000))
+    
+    def item(class_name: str, name: str, inner: str, source: Optional[str] = None) -> str:
+        properties = f'<string name="Name">{xml_escape(name)}</string>'
+        if source is not None:
+            properties += f'<ProtectedString name="Source">{_cdata(source)}</ProtectedString>'
+        return (f'<Item class="{class_name}" referent="RBX{next(referents)}">'
+                f'<Properties>{properties}</Properties>{inner}</Item>')
+    
+    def render(node: Dict[str, Any]) -> str:
+        parts = []
+        for folder, child in node.items():
+            if folder != "__scripts__":
+                parts.append(item("Folder", folder, render(child)))
+        for block in node.get("__scripts__", []):
+            class_name = block["type"] if block["type"] in ROBLOX_SCRIPT_CLASSES else "Script"
+            parts.append(item(class_name, roblox_script_name(block["filename"]), "", block["code"]))
+        return "".join(parts)
+    
+    return ('<roblox xmlns:xmime="http://www.w3.org/2005/05/xmlmime" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'xsi:noNamespaceSchemaLocation="http://www.roblox.com/roblox.xsd" version="4">'
+            f'{render(tree)}</roblox>')
+
+def build_system_bundle(code_blocks: List[Dict[str, str]], instructions: str,
+                        name: str = "PolarDevSistema") -> tuple:
+    """Pacote .zip em memória com os .lua nas pastas certas, o .rbxmx e o guia de instalação"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as bundle:
+        used = set()
+        for block in code_blocks:
+            arcname = f"{block['path'].strip('/')}/{os.path.basename(block['filename'])}"
+            # Nomes repetidos viram Main_2.server.lua, Main_3.server.lua, ...: o número vai antes
+            # do primeiro ponto para manter o sufixo (.server.lua/.client.lua) que define o tipo
+            folder, filename = arcname.rsplit("/", 1)
+            stem, dot, suffix = filename.partition(".")
+            counter = 2
+            while arcname in used:
+                arcname = f"{folder}/{stem}_{counter}{dot}{suffix}"
+                counter += 1
+            used.add(arcname)
+            bundle.writestr(arcname, block["code"])
+        
+        bundle.writestr(f"{name}.rbxmx", build_rbxmx(code_blocks))
+        bundle.writestr("INSTALACAO.txt", (
+            f"{instructions}\n\n"
+            f"IMPORTAR O MODELO:\n"
+            f"1. No Roblox Studio, clique com o botão direito no Workspace > Insert from File... > {name}.rbxmx\n"
+            f"2. Mova o conteúdo de cada pasta (ServerScriptService, StarterPack, ...) para o serviço de mesmo nome\n"
+        ))
+    return f"{name}.zip", buffer.getvalue()
+
+# ================= ENTREGA DO CÓDIGO =================
+def code_file_embed(code_block: Dict[str, str], attached: bool, bundled: bool = False) -> discord.Embed:
+    code = code_block["code"]
+    description = (
+        f"**TIPO:** {code_block['type']}\n"
+        f"**LOCAL:** {code_block['path']}\n"
+        f"**TAMANHO:** {len(code)} caracteres"
+    )
+    if attached:
+        description += "\n📦 **Código no pacote .zip**" if bundled else "\n📎 **Código no anexo abaixo**"
+    else:
+        description += f"\n```lua\n{code}\n```"
+    return create_embed(f"📄 {code_block['filename']}", description, COLORS["info"])
+
+def build_code_delivery(header: discord.Embed, code_blocks: List[Dict[str, str]],
+                        footer: Optional[discord.Embed] = None,
+                        bundle: Optional[tuple] = None) -> List[Dict[str, Any]]:
+    """Agrupa a saída de uma criação no menor número de mensagens
+    
+    Scripts curtos vão dentro do embed do arquivo; os longos viram anexos .lua, ou
+    ficam só no pacote quando `bundle` (nome, bytes) é enviado junto do cabeçalho.
+    Cada mensagem respeita os limites do Discord: 10 embeds / 6000 caracteres de
+    embed e 10 anexos por mensagem.
+    """
+    items = [(header, bundle)]
+    used_names = set()
+    for code_block in code_blocks:
+        attached = len(code_block["code"]) > INLINE_CODE_MAX_CHARS
+        attachment = None
+        if attached and bundle is None:
+            name = os.path.basename(code_block["filename"]) or "Script.lua"
+            if name in used_names:
+                name = f"{len(used_names) + 1}_{name}"
+            used_names.add(name)
+            attachment = (name, code_block["code"].encode('utf-8'))
+        items.append((code_file_embed(code_block, attached, bundled=bundle is not None), attachment))
+    if footer is not None:
+        items.append((footer, None))
+    
+    messages = []
+    current = {"embeds": [], "files": []}
+    embed_chars = 0
+    for embed, attachment in items:
+        size = len(embed)
+        full = (
+            len(current["embeds"]) >= 10
+            or embed_chars + size > 6000
+            or (attachment is not None and len(current["files"]) >= 10)
+        )
+        if full and current["embeds"]:
+            messages.append(current)
+            current = {"embeds": [], "files": []}
+            embed_chars = 0
+        current["embeds"].append(embed)
+        if attachment is not None:
+            current["files"].append(attachment)
+        embed_chars += size
+    if current["embeds"]:
+        messages.append(current)
+    return messages
+
+async def send_code_delivery(channel: discord.abc.Messageable, messages: List[Dict[str, Any]]):
+    """Envia as mensagens em sequência; o discord.py espera pelos buckets de rate limit da rota"""
+    with code_delivery_seconds.time():
+        for message in messages:
+            files = [discord.File(io.BytesIO(data), filename=name) for name, data in message["files"]]
+            with discord_send_seconds.time(route="code_delivery"):
+                await channel.send(embeds=message["embeds"], files=files)
+
+# ================= FILA DE CRIAÇÕES =================
+class JobQueue:
+    """Fila durável das criações de sistemas
+    
+    Os jobs ficam na tabela "jobs" do banco, criados na mesma operação que cobra os
+    créditos. `workers` tarefas consomem a fila e chamam `runner(job_id, job)`, que
+    retorna None quando o resultado foi entregue ou a mensagem de erro. Jobs com erro
+    são reembolsados (e `on_refund` avisa o usuário). No início, jobs pendentes de uma
+    execução anterior voltam para a fila, ou são reembolsados após JOB_MAX_ATTEMPTS.
+    """
+    def __init__(self, database, workers: int, runner: Callable, on_refund: Optional[Callable] = None):
+        self.db = database
+        self.workers = max(1, workers)
+        self.runner = runner
+        self.on_refund = on_refund
+        
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._queued: OrderedDict = OrderedDict()   # job_id -> None, para a posição na fila
+        self._running: set = set()
+        self._tasks: List[asyncio.Task] = []
+        
+        self.completed = 0
+        self.refunded = 0
+        self.resumed = 0
+    
+    def _enqueue(self, job_id: str):
+        self._queued[job_id] = None
+        self._queue.put_nowait(job_id)
+    
+    def submit(self, user_id: str, channel_id, message_id, description: str, use_cache: bool,
+               cost: float) -> Optional[str]:
+        """Cobra e enfileira uma criação; retorna o id do job ou None se faltar saldo"""
+        job_id = "job-" + "".join(random.choices(string.ascii_lowercase + string.digits, k=12))
+        if self.db.enqueue_job(job_id, user_id, channel_id, message_id, description, use_cache, cost) is None:
+            return None
+        credits_total.inc(cost, operation="deducted")
+        self._enqueue(job_id)
+        return job_id
+    
+    def position(self, job_id: str) -> int:
+        """Posição do job na fila de criações (0 = já em execução ou um worker livre vai pegá-lo)"""
+        free_workers = self.workers - len(self._running)
+        for position, queued_id in enumerate(self._queued, start=1):
+            if queued_id == job_id:
+                return max(0, position - free_workers)
+        return 0
+    
+    async def start(self):
+        """Retoma ou reembolsa os jobs pendentes e sobe os workers"""
+        retention_cutoff = (datetime.now() - timedelta(seconds=JOB_RETENTION)).isoformat()
+        pruned = self.db.prune_jobs(retention_cutoff)
+        
+        for job_id, job in self.db.pending_jobs():
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                await self._refund(job_id, job, "O bot reiniciou várias vezes durante a criação.")
+                continue
+            self.db.update_job(job_id, state=JOB_QUEUED)
+            self._enqueue(job_id)
+            self.resumed += 1
+        
+        if self.resumed or pruned:
+            logger.info(f"Fila de criações: {self.resumed} jobs retomados, {pruned} finalizados removidos")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        """Para os workers; jobs em execução continuam "running" e são retomados no próximo início"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._queued.pop(job_id, None)
+            job = self.db.get_job(job_id)
+            if job is None or job["state"] not in JOB_PENDING_STATES:
+                continue
+            
+            job["attempts"] += 1
+            self.db.update_job(job_id, state=JOB_RUNNING, attempts=job["attempts"])
+            self._running.add(job_id)
+            try:
+                if JOB_TIMEOUT > 0:
+                    error = await asyncio.wait_for(self.runner(job_id, job), timeout=JOB_TIMEOUT)
+                else:
+                    error = await self.runner(job_id, job)
+            except asyncio.TimeoutError:
+                error = f"A criação passou de {JOB_TIMEOUT:.0f} segundos."
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Erro no job {job_id}: {e}")
+                error = "Ocorreu um erro inesperado."
+            finally:
+                self._running.discard(job_id)
+            
+            if error is None:
+                self.db.update_job(job_id, state=JOB_DONE, error=None)
+                self.completed += 1
+            else:
+                await self._refund(job_id, job, error)
+    
+    async def _refund(self, job_id: str, job: Dict, error: str):
+        balance = self.db.refund_job(job_id, error)
+        if balance is None:
+            return
+        self.refunded += 1
+        credits_total.inc(job["cost"], operation="refunded")
+        if self.on_refund:
+            try:
+                await self.on_refund(job_id, job, error, balance)
+            except Exception as e:
+                logger.error(f"Erro ao avisar reembolso do job {job_id}: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": len(self._queued),
+            "running": len(self._running),
+            "completed": self.completed,
+            "refunded": self.refunded,
+            "resumed": self.resumed
+        }
+
+def creation_processing_embed(description: str, truncated: bool = False) -> discord.Embed:
+    embed = create_embed(
+        "⏳ PolarDev está criando seu sistema Roblox...",
+        f"**SISTEMA:** {description[:200]}...\n\n"
+        f"🎮 **PLATAFORMA:** Roblox Studio\n"
+        f"📝 **LINGUAGEM:** Lua/Luau\n"
+        f"📦 **SAÍDA:** Scripts, LocalScripts, ModuleScripts\n"
+        f"⚡ **STATUS:** Gerando código profissional...\n\n"
+        f"O resultado será enviado neste canal quando ficar pronto.",
+        COLORS["info"]
+    )
+    if truncated:
+        embed.description += (
+            f"\n\n✂️ Descrição longa demais: usando só os primeiros ~{CREATION_DESCRIPTION_MAX_TOKENS} tokens."
+        )
+    return embed
+
+async def fetch_job_channel(job: Dict) -> Optional[discord.abc.Messageable]:
+    channel = bot.get_channel(int(job["channel_id"]))
+    if channel is None:
+        try:
+            channel = await bot.fetch_channel(int(job["channel_id"]))
+        except discord.HTTPException:
+            return None
+    return channel
+
+async def run_creation_job(job_id: str, job: Dict) -> Optional[str]:
+    """Worker da fila: gera o sistema e entrega no canal do job (None = entregue)"""
+    await bot.wait_until_ready()
+    channel = await fetch_job_channel(job)
+    if channel is None:
+        return "O canal da criação não existe mais."
+    
+    user_id = job["user_id"]
+    description = job["description"]
+    creation_task = asyncio.create_task(
+        ai.create_roblox_system(description, use_cache=job["use_cache"], user_id=user_id)
+    )
+    position_task = None
+    if job.get("message_id"):
+        # Mensagem "criando..." do envio: sai da fila de criações e passa a mostrar a fila da IA
+        message = channel.get_partial_message(int(job["message_id"]))
+        embed = creation_processing_embed(description)
+        if job["attempts"] > 1:
+            embed.description += "\n\n🔄 Criação retomada após reinício do bot."
+        try:
+            await message.edit(embed=embed)
+        except discord.HTTPException:
+            pass
+        position_task = asyncio.create_task(
+            report_queue_position(message, embed, user_id, LANE_CREATION, creation_task)
+        )
+    
+    try:
+        result = await creation_task
+    finally:
+        creation_task.cancel()
+        if position_task:
+            position_task.cancel()
+    
+    if not result["success"]:
+        return result["error"]
+    
+    user_data = db.get_user(user_id) or {"credits": 0}
+    success_embed = create_embed(
+        "✅ SISTEMA ROBLOX CRIADO COM SUCESSO!",
+        f"**DESCRIÇÃO:** {description[:150]}...\n\n"
+        f"🎮 **PLATAFORMA:** Roblox Studio\n"
+        f"📦 **ARQUIVOS:** {len(result['code_blocks'])} scripts gerados\n"
+        f"💰 **CUSTO:** {format_credits(job['cost'])} deduzido\n"
+        f"💳 **NOVO SALDO:** {format_credits(user_data['credits'])}\n"
+        f"🤖 **IA:** Groq Llama 3 70B\n\n"
+        f"⬇️ **CÓDIGO LUA/LUAU ABAIXO:**",
+        COLORS["creation"]
+    )
+    if result.get("cached"):
+        success_embed.add_field(
+            name="♻️ Reaproveitado",
+            value=f"Sistema parecido já gerado (similaridade {result['similarity']:.0%}).\n"
+                  f"Responda **sim** em \"Gerar do zero?\" para um sistema novo.",
+            inline=False
+        )
+    
+    instructions_embed = create_embed(
+        "📋 GUIA DE INSTALAÇÃO NO ROBLOX STUDIO",
+        f"{result['instructions']}\n\n"
+        f"🔧 **DICAS IMPORTANTES:**\n"
+        f"1. Teste SEMPRE em Play Solo primeiro\n"
+        f"2. Verifique o Output para erros\n"
+        f"3. Ajuste IDs e nomes conforme seu jogo\n"
+        f"4. Faça backup antes de publicar",
+        COLORS["primary"]
+    )
+    
+    bundle = None
+    if CREATION_BUNDLE:
+        bundle = build_system_bundle(result["code_blocks"], result["instructions"])
+        success_embed.add_field(
+            name="📦 Pacote",
+            value=f"`{bundle[0]}` com todos os scripts nas pastas certas e um modelo `.rbxmx` "
+                  f"para importar tudo de uma vez no Studio.",
+            inline=False
+        )
+    
+    await send_code_delivery(
+        channel,
+        build_code_delivery(success_embed, result["code_blocks"], instructions_embed, bundle=bundle)
+    )
+    return None
+
+async def notify_job_refund(job_id: str, job: Dict, error: str, balance: float):
+    channel = await fetch_job_channel(job)
+    if channel is None:
+        return
+    await channel.send(
+        content=f"<@{job['user_id']}>",
+        embed=create_embed("❌ ERRO NA CRIAÇÃO", 
+                         f"{error}\n\n"
+                         f"**Seus créditos foram devolvidos.** Saldo: {format_credits(balance)}\n\n"
+                         "Possíveis causas:\n"
+                         "• Descrição muito vaga\n"
+                         "• API temporariamente indisponível\n\n"
+                         "**SUGESTÕES:**\n"
+                         "1. Seja mais específico\n"
+                         "2. Tente novamente em 1-2 minutos",
+                         COLORS["error"])
+    )
+
+creation_jobs = JobQueue(db, JOB_WORKERS, run_creation_job, on_refund=notify_job_refund)
+
+# ================= CATEGORIAS DOS CHATS =================
+class ChatCategories:
+    """Distribui os chats entre "🤖 PolarDev Chats", "🤖 PolarDev Chats 2", ...
+    
+    Guarda por servidor os ids das categorias em ordem, então achar onde criar um chat
+    não varre guild.categories (só na primeira vez ou se a categoria sumir). Categorias
+    extras que ficam vazias são apagadas.
+    """
+    def __init__(self, base_name: str, channel_limit: int):
+        self.base_name = base_name
+        self.channel_limit = channel_limit
+        self._pattern = re.compile(rf"^{re.escape(base_name)}(?: (\d+))?$")
+        self._by_guild: Dict[int, Dict[int, int]] = {}   # servidor -> {número: id da categoria}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        
+        self.created = 0
+        self.reclaimed = 0
+    
+    def number(self, category) -> Optional[int]:
+        """Número da categoria de chats (1 = a principal) ou None se não for uma delas"""
+        if category is None:
+            return None
+        match = self._pattern.match(category.name)
+        if not match:
+            return None
+        return int(match.group(1) or 1)
+    
+    def is_chat_category(self, category) -> bool:
+        return self.number(category) is not None
+    
+    def _categories(self, guild: discord.Guild) -> Dict[int, int]:
+        cached = self._by_guild.get(guild.id)
+        if cached is None or any(guild.get_channel(cid) is None for cid in cached.values()):
+            cached = {}
+            for category in guild.categories:
+                number = self.number(category)
+                if number is not None and number not in cached:
+                    cached[number] = category.id
+            self._by_guild[guild.id] = cached
+        return cached
+    
+    async def create_chat_channel(self, guild: discord.Guild, **kwargs) -> discord.TextChannel:
+        """Cria o canal na primeira categoria com vaga, abrindo uma nova se todas estiverem cheias"""
+        lock = self._locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            categories = self._categories(guild)
+            for number in sorted(categories):
+                category = guild.get_channel(categories[number])
+                if len(category.channels) < self.channel_limit:
+                    break
+            else:
+                number = next(n for n in range(1, len(categories) + 2) if n not in categories)
+                name = self.base_name if number == 1 else f"{self.base_name} {number}"
+                category = await guild.create_category(name)
+                categories[number] = category.id
+                self.created += 1
+                logger.info(f"Categoria de chats criada: {name} ({guild.name})")
+            
+            return await category.create_text_channel(**kwargs)
+    
+    async def reclaim(self, category):
+        """Apaga uma categoria extra (2, 3, ...) que ficou sem canais"""
+        number = self.number(category)
+        if not number or number == 1:
+            return
+        # Mesmo lock da criação: não apaga uma categoria que está recebendo um canal
+        async with self._locks.setdefault(category.guild.id, asyncio.Lock()):
+            if category.channels:
+                return
+            try:
+                await category.delete(reason="Categoria extra de chats vazia")
+            except discord.HTTPException as e:
+                logger.warning(f"Não foi possível apagar a categoria {category.name}: {e}")
+                return
+            self.forget(category)
+            self.reclaimed += 1
+    
+    def forget(self, category):
+        cached = self._by_guild.get(category.guild.id)
+        if cached and cached.get(self.number(category)) == category.id:
+            del cached[self.number(category)]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "guilds": len(self._by_guild),
+            "categories": sum(len(c) for c in self._by_guild.values()),
+            "created": self.created,
+            "reclaimed": self.reclaimed
+        }
+
+chat_categories = ChatCategories(CATEGORY_NAME, CATEGORY_CHANNEL_LIMIT)
+
+# ================= EXPIRAÇÃO DOS CHATS =================
+class ChatExpiry:
+    """Agenda a expiração dos chats num min-heap de (vencimento, canal)
+    
+    Vencimento = última atividade + ttl. Atividade nova não mexe no heap:
+    fica em _activity e, quando a entrada antiga vence, ela volta ao heap com o prazo
+    novo. Cada tick só toca nos chats que realmente venceram.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._heap: List[tuple] = []
+        self._activity: Dict[str, float] = {}    # canal -> última atividade (epoch)
+        self._persisted: Dict[str, float] = {}   # canal -> última atividade gravada no banco
+        self.expired = 0
+    
+    @staticmethod
+    def _timestamp(chat_data: Dict) -> Optional[float]:
+        try:
+            return datetime.fromisoformat(chat_data["last_activity"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return None
+    
+    def rebuild(self, chats) -> List[str]:
+        """Monta o heap a partir dos chats do banco (uma vez, no início)
+        
+        Chats sem last_activity (criados antes de a atividade ser registrada) começam a
+        contar agora, e não desde a criação: senão todos os antigos venceriam de uma vez.
+        Retorna esses canais, para gravar o início da contagem no banco.
+        """
+        now = time.time()
+        self._heap = []
+        unstamped = []
+        for channel_id, chat_data in chats:
+            last_activity = self._timestamp(chat_data)
+            if last_activity is None:
+                last_activity = now
+                unstamped.append(str(channel_id))
+            self._heap.append((last_activity + self.ttl, str(channel_id)))
+        heapq.heapify(self._heap)
+        self._activity.clear()
+        return unstamped
+    
+    def add(self, channel_id, at: Optional[float] = None):
+        heapq.heappush(self._heap, ((at or time.time()) + self.ttl, str(channel_id)))
+    
+    def retry_later(self, channel_id, delay: float):
+        heapq.heappush(self._heap, (time.time() + delay, str(channel_id)))
+    
+    def touch(self, channel_id) -> bool:
+        """Registra atividade; True quando é hora de gravar no banco (no máximo 1x por CHAT_ACTIVITY_PERSIST)"""
+        channel_id = str(channel_id)
+        now = time.time()
+        self._activity[channel_id] = now
+        if now - self._persisted.get(channel_id, 0) >= CHAT_ACTIVITY_PERSIST:
+            self._persisted[channel_id] = now
+            return True
+        return False
+    
+    def forget(self, channel_id):
+        # A entrada no heap sai sozinha quando vencer (o chat não existe mais no banco)
+        self._activity.pop(str(channel_id), None)
+        self._persisted.pop(str(channel_id), None)
+    
+    def pop_due(self, limit: int, now: Optional[float] = None) -> List[str]:
+        """Tira do heap até `limit` chats vencidos, reagendando os que tiveram atividade"""
+        now = now or time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            _, channel_id = heapq.heappop(self._heap)
+            last_activity = self._activity.get(channel_id)
+            if last_activity is not None and last_activity + self.ttl > now:
+                heapq.heappush(self._heap, (last_activity + self.ttl, channel_id))
+                continue
+            due.append(channel_id)
+        return due
+    
+    def pending(self, now: Optional[float] = None) -> int:
+        """Chats vencidos ainda não processados (percorre só o topo do heap)"""
+        now = now or time.time()
+        heap = self._heap
+        count = 0
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i >= len(heap) or heap[i][0] > now:
+                continue
+            last_activity = self._activity.get(heap[i][1])
+            if last_activity is None or last_activity + self.ttl <= now:
+                count += 1
+            stack.extend((2 * i + 1, 2 * i + 2))
+        return count
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tracked": len(self._heap),
+            "pending": self.pending(),
+            "expired": self.expired
+        }
+
+chat_expiry = ChatExpiry(CHAT_EXPIRY_DAYS * 86400)
+
+async def archive_chat(channel_id: str, chat_data: Dict):
+    """Guarda em data/archive/<canal>.json o registro do chat e a memória da conversa"""
+    payload = json.dumps({
+        "channel_id": channel_id,
+        "chat": chat_data,
+        "conversation": await ai.conversations.export(channel_id),
+        "archived_at": datetime.now().isoformat()
+    }, ensure_ascii=False, indent=2)
+    
+    def write():
+        os.makedirs(CHAT_ARCHIVE_DIR, exist_ok=True)
+        write_file_atomic(os.path.join(CHAT_ARCHIVE_DIR, f"{channel_id}.json"), payload)
+    await asyncio.to_thread(write)
+
+# ================= AGRUPAMENTO DE MENSAGENS =================
+class ChatDebouncer:
+    """Junta mensagens seguidas do dono de um chat numa única pergunta para a IA
+    
+    Cada mensagem reinicia a janela de `window` segundos do canal; quando ela fecha, o
+    texto acumulado vai para `respond(channel, user_id, text, commit)`. Se chegar outra
+    mensagem antes de a resposta começar a aparecer (commit()), a requisição em andamento
+    é cancelada e refeita com todas as mensagens. Depois do commit, mensagens novas
+    esperam a resposta atual terminar e formam o próximo lote.
+    """
+    def __init__(self, window: float, respond: Callable):
+        self.window = window
+        self.respond = respond
+        self._pending: Dict[str, List[str]] = {}   # canal -> mensagens ainda não respondidas
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._committed: set = set()
+        self._responding: set = set()   # canais com requisição à IA em andamento
+        
+        self.batches = 0
+        self.coalesced = 0   # mensagens que entraram num lote com outras
+        self.cancelled = 0   # requisições canceladas por mensagem nova
+    
+    def submit(self, message: discord.Message):
+        channel_id = str(message.channel.id)
+        pending = self._pending.setdefault(channel_id, [])
+        pending.append(message.content)
+        if len(pending) > 1:
+            self.coalesced += 1
+        
+        task = self._tasks.get(channel_id)
+        if task and not task.done():
+            if channel_id in self._committed:
+                return
+            task.cancel()
+            if channel_id in self._responding:
+                self._responding.discard(channel_id)
+                self.cancelled += 1
+        self._schedule(channel_id, message)
+    
+    def _schedule(self, channel_id: str, message: discord.Message):
+        self._tasks[channel_id] = asyncio.create_task(self._run(channel_id, message))
+    
+    async def _run(self, channel_id: str, message: discord.Message):
+        batch_size = 0
+        
+        def commit():
+            # A resposta começou a aparecer no canal: o lote sai da fila
+            if channel_id not in self._committed:
+                self._committed.add(channel_id)
+                del self._pending.get(channel_id, [])[:batch_size]
+        
+        try:
+            await asyncio.sleep(self.window)
+            batch = self._pending.get(channel_id, [])
+            batch_size = len(batch)
+            if not batch_size:
+                return
+            self.batches += 1
+            self._responding.add(channel_id)
+            await self.respond(message.channel, str(message.author.id), "\n".join(batch), commit)
+            commit()
+        finally:
+            if self._tasks.get(channel_id) is asyncio.current_task():
+                del self._tasks[channel_id]
+                self._committed.discard(channel_id)
+                self._responding.discard(channel_id)
+                if self._pending.get(channel_id):
+                    self._schedule(channel_id, message)
+                else:
+                    self._pending.pop(channel_id, None)
+    
+    def forget(self, channel_id):
+        channel_id = str(channel_id)
+        self._pending.pop(channel_id, None)
+        task = self._tasks.pop(channel_id, None)
+        if task:
+            task.cancel()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_seconds": self.window,
+            "active_channels": len(self._tasks),
+            "batches": self.batches,
+            "coalesced_messages": self.coalesced,
+            "cancelled_requests": self.cancelled
+        }
+
+async def answer_chat(channel: discord.abc.Messageable, user_id: str, text: str, commit: Callable[[], None]):
+    """Responde um lote de mensagens do chat (com stream ou de uma vez)"""
+    started = time.perf_counter()
+    try:
+        if CHAT_STREAMING:
+            # Envia um placeholder e vai editando conforme os tokens chegam
+            reply = StreamingReply(channel, transform=ai.clean_response, on_commit=commit)
+            await reply.run(
+                ai.generate_response_stream(text, user_id=user_id, channel_id=str(channel.id)),
+                queue_position=ai.scheduler.estimate_position(user_id, LANE_CHAT)
+            )
+        else:
+            # Mostra que está digitando
+            async with channel.typing():
+                # Gera resposta
+                response = await ai.generate_response(text, user_id=user_id, channel_id=str(channel.id))
+            
+            # Envia a resposta
+            if response:
+                commit()
+                await channel.send(response)
+    
+    except Exception as e:
+        logger.error(f"Erro ao responder: {e}")
+        await channel.send("🤖 Oops, tive um problema ao processar sua mensagem. Tente novamente!")
+    finally:
+        chat_reply_seconds.observe(time.perf_counter() - started, mode="stream" if CHAT_STREAMING else "full")
+
+chat_debouncer = ChatDebouncer(CHAT_DEBOUNCE_SECONDS, answer_chat)
+
 # ================= COMANDOS =================
 @bot.tree.command(name="criar_key", description="🔑 Criar keys de créditos (CEO/Support)")
 @app_commands.describe(
@@ -614,15 +4257,16 @@ async def resgatar(interaction: discord.Interaction, key: str):
         )
         return
     
-    credits = db.use_key(key, str(interaction.user.id))
-    if credits is None:
+    redeemed = db.redeem_key(key, str(interaction.user.id))
+    if redeemed is None:
         await interaction.response.send_message(
             embed=create_embed("❌ Key inválida", "Key não existe ou já foi usada", COLORS["error"]),
             ephemeral=True
         )
         return
     
-    new_balance = db.add_credits(str(interaction.user.id), credits)
+    credits, new_balance = redeemed
+    credits_total.inc(credits, operation="redeemed")
     
     embed = create_embed(
         "🎉 Key Resgatada!",
@@ -663,21 +4307,12 @@ async def criar_chat(interaction: discord.Interaction, nome: Optional[str] = Non
     try:
         guild = interaction.guild
         
-        category = discord.utils.get(guild.categories, name=CATEGORY_NAME)
-        if not category:
-            try:
-                category = await guild.create_category(CATEGORY_NAME)
-            except:
-                await interaction.response.send_message(
-                    embed=create_embed("❌ Erro", "Sem permissão para criar categoria.", COLORS["error"]),
-                    ephemeral=True
-                )
-                return
-        
-        for channel in category.channels:
-            if str(interaction.user.id) in channel.name:
+        # Chat já existente neste servidor, pelo índice dono -> canais
+        for channel_id in db.get_owner_chats(interaction.user.id):
+            existing = guild.get_channel(int(channel_id))
+            if existing is not None:
                 await interaction.response.send_message(
-                    embed=create_embed("⚠️ Chat Existente", f"Você já tem um chat: {channel.mention}", COLORS["warning"]),
+                    embed=create_embed("⚠️ Chat Existente", f"Você já tem um chat: {existing.mention}", COLORS["warning"]),
                     ephemeral=True
                 )
                 return
@@ -692,13 +4327,22 @@ async def criar_chat(interaction: discord.Interaction, nome: Optional[str] = Non
             guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True)
         }
         
-        channel = await category.create_text_channel(
-            name=channel_name,
-            overwrites=overwrites,
-            topic=f"🤖 Chat PolarDev com {interaction.user.name} • Especialista em Roblox Lua/Luau"
-        )
+        try:
+            channel = await chat_categories.create_chat_channel(
+                guild,
+                name=channel_name,
+                overwrites=overwrites,
+                topic=f"🤖 Chat PolarDev com {interaction.user.name} • Especialista em Roblox Lua/Luau"
+            )
+        except discord.Forbidden:
+            await interaction.response.send_message(
+                embed=create_embed("❌ Erro", "Sem permissão para criar categoria ou canal.", COLORS["error"]),
+                ephemeral=True
+            )
+            return
         
         db.register_chat(str(channel.id), str(interaction.user.id), channel_name)
+        chat_expiry.add(channel.id)
         
         welcome_embed = discord.Embed(
             title="🤖 BEM-VINDO AO POLARDEV ROBLOX STUDIO!",
@@ -780,11 +4424,29 @@ class RobloxSystemCreationModal(discord.ui.Modal, title="🎮 Criar Sistema Robl
             max_length=2000
         )
         
+        self.skip_cache = discord.ui.TextInput(
+            label="Gerar do zero? (sim/não)",
+            placeholder="Deixe vazio para reaproveitar um sistema parecido já gerado",
+            style=discord.TextStyle.short,
+            required=False,
+            max_length=3
+        )
+        
         self.add_item(self.description)
+        self.add_item(self.skip_cache)
     
     async def on_submit(self, interaction: discord.Interaction):
+        retry_after, _ = rate_limiter.hit("criar_sistema", self.user_id, interaction.guild_id)
+        if retry_after:
+            await interaction.response.send_message(embed=slow_down_embed(retry_after), ephemeral=True)
+            return
+        
         await interaction.response.defer(thinking=True)
         
+        # Descrições enormes são cortadas antes de ir para a IA (e antes de cobrar)
+        description = truncate_to_tokens(self.description.value, CREATION_DESCRIPTION_MAX_TOKENS)
+        truncated = len(description) < len(self.description.value)
+        
         user_data = db.get_user(self.user_id)
         if not user_data or user_data["credits"] < COST_PER_CREATION:
             await interaction.followup.send(
@@ -793,118 +4455,23 @@ class RobloxSystemCreationModal(discord.ui.Modal, title="🎮 Criar Sistema Robl
             )
             return
         
-        if not db.deduct_credits(self.user_id, COST_PER_CREATION):
-            await interaction.followup.send(
-                embed=create_embed("❌ Erro", "Falha ao processar créditos.", COLORS["error"]),
-                ephemeral=True
-            )
-            return
+        processing_embed = creation_processing_embed(description, truncated)
+        processing_message = await interaction.followup.send(embed=processing_embed, wait=True)
         
-        processing_embed = create_embed(
-            "⏳ PolarDev está criando seu sistema Roblox...",
-            f"**SISTEMA:** {self.description.value[:200]}...\n\n"
-            f"🎮 **PLATAFORMA:** Roblox Studio\n"
-            f"📝 **LINGUAGEM:** Lua/Luau\n"
-            f"📦 **SAÍDA:** Scripts, LocalScripts, ModuleScripts\n"
-            f"⚡ **STATUS:** Gerando código profissional...\n\n"
-            f"Isso pode levar até 45 segundos para sistemas complexos.",
-            COLORS["info"]
+        use_cache = normalize_prompt(self.skip_cache.value or "") not in ("sim", "s", "yes", "y")
+        job_id = creation_jobs.submit(
+            self.user_id, interaction.channel_id, processing_message.id, description, use_cache, COST_PER_CREATION
         )
-        await interaction.followup.send(embed=processing_embed)
-        
-        try:
-            creation_task = asyncio.create_task(ai.create_roblox_system(self.description.value))
-            result = await asyncio.wait_for(creation_task, timeout=60)
-            
-            if result["success"]:
-                success_embed = create_embed(
-                    "✅ SISTEMA ROBLOX CRIADO COM SUCESSO!",
-                    f"**DESCRIÇÃO:** {self.description.value[:150]}...\n\n"
-                    f"🎮 **PLATAFORMA:** Roblox Studio\n"
-                    f"📦 **ARQUIVOS:** {len(result['code_blocks'])} scripts gerados\n"
-                    f"💰 **CUSTO:** {format_credits(COST_PER_CREATION)} deduzido\n"
-                    f"💳 **NOVO SALDO:** {format_credits(user_data['credits'] - COST_PER_CREATION)}\n"
-                    f"🤖 **IA:** Groq Llama 3 70B\n\n"
-                    f"⬇️ **CÓDIGO LUA/LUAU ABAIXO:**",
-                    COLORS["creation"]
-                )
-                
-                await interaction.channel.send(embed=success_embed)
-                
-                for code_block in result["code_blocks"]:
-                    filename = code_block["filename"]
-                    code = code_block["code"]
-                    script_type = code_block["type"]
-                    path = code_block["path"]
-                    
-                    file_embed = create_embed(
-                        f"📄 {filename}",
-                        f"**TIPO:** {script_type}\n"
-                        f"**LOCAL:** {path}\n"
-                        f"**TAMANHO:** {len(code)} caracteres",
-                        COLORS["info"]
-                    )
-                    await interaction.channel.send(embed=file_embed)
-                    
-                    if len(code) > 1900:
-                        chunks = [code[i:i+1900] for i in range(0, len(code), 1900)]
-                        for i, chunk in enumerate(chunks, 1):
-                            if chunk.strip():
-                                await interaction.channel.send(f"**Parte {i}/{len(chunks)}:**\n```lua\n{chunk}\n```")
-                    else:
-                        await interaction.channel.send(f"```lua\n{code}\n```")
-                    
-                    await asyncio.sleep(0.5)
-                
-                instructions_embed = create_embed(
-                    "📋 GUIA DE INSTALAÇÃO NO ROBLOX STUDIO",
-                    f"{result['instructions']}\n\n"
-                    f"🔧 **DICAS IMPORTANTES:**\n"
-                    f"1. Teste SEMPRE em Play Solo primeiro\n"
-                    f"2. Verifique o Output para erros\n"
-                    f"3. Ajuste IDs e nomes conforme seu jogo\n"
-                    f"4. Faça backup antes de publicar",
-                    COLORS["primary"]
-                )
-                await interaction.channel.send(embed=instructions_embed)
-                
-            else:
-                db.add_credits(self.user_id, COST_PER_CREATION)
-                await interaction.followup.send(
-                    embed=create_embed("❌ ERRO NA CRIAÇÃO", 
-                                     f"{result['error']}\n\n"
-                                     "**Seus créditos foram devolvidos.**\n\n"
-                                     "Possíveis causas:\n"
-                                     "• Descrição muito vaga\n"
-                                     "• API temporariamente indisponível\n\n"
-                                     "**SUGESTÕES:**\n"
-                                     "1. Seja mais específico\n"
-                                     "2. Tente novamente em 1-2 minutos",
-                                     COLORS["error"]),
-                    ephemeral=True
-                )
-                
-        except asyncio.TimeoutError:
-            db.add_credits(self.user_id, COST_PER_CREATION)
-            await interaction.followup.send(
-                embed=create_embed("⏱️ TIMEOUT", 
-                                 "A criação demorou muito (mais de 60 segundos).\n"
-                                 "**Seus créditos foram devolvidos.**\n\n"
-                                 "Tente com uma descrição mais específica.",
-                                 COLORS["error"]),
-                ephemeral=True
-            )
-        except Exception as e:
-            logger.error(f"Erro na criação: {e}")
-            db.add_credits(self.user_id, COST_PER_CREATION)
-            await interaction.followup.send(
-                embed=create_embed("❌ ERRO INESPERADO", 
-                                 f"Ocorreu um erro inesperado.\n"
-                                 "**Seus créditos foram devolvidos.**\n\n"
-                                 "Tente novamente ou contate suporte.",
-                                 COLORS["error"]),
-                ephemeral=True
+        if job_id is None:
+            await processing_message.edit(
+                embed=create_embed("❌ Créditos Insuficientes", f"Você precisa de {format_credits(COST_PER_CREATION)}.", COLORS["error"])
             )
+            return
+        
+        position = creation_jobs.position(job_id)
+        if position:
+            processing_embed.add_field(name="🕒 Fila de criações", value=f"Você é o **{position}º** da fila", inline=False)
+            await processing_message.edit(embed=processing_embed)
 
 @bot.tree.command(name="ping", description="🏓 Verifica latência do bot")
 async def ping(interaction: discord.Interaction):
@@ -914,13 +4481,45 @@ async def ping(interaction: discord.Interaction):
         f"📡 **Latência:** {latency}ms\n"
         f"🎮 **ESPECIALIDADE:** Roblox Lua/Luau\n"
         f"🤖 **IA:** Groq (Llama 3 70B) - GRATUITA\n"
-        f"👥 **Desenvolvedores:** {len(db.users)}\n"
-        f"💬 **Sistemas ativos:** {len(db.chats)}\n"
+        f"👥 **Desenvolvedores:** {db.count_users()}\n"
+        f"💬 **Sistemas ativos:** {db.count_chats()}\n"
         f"🌐 **Status:** Online ✅",
         COLORS["primary"]
     )
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+@bot.tree.command(name="travamentos", description="🐢 Últimos travamentos do loop do bot (CEO)")
+@app_commands.describe(quantidade="Quantas capturas mostrar (1-5)")
+async def travamentos(interaction: discord.Interaction, quantidade: int = 3):
+    if not is_ceo(interaction.user):
+        await interaction.response.send_message(
+            embed=create_embed("❌ Permissão Negada", f"Requer cargo {CEO_ROLE}", COLORS["error"]),
+            ephemeral=True
+        )
+        return
+    
+    stats = loop_watchdog.stats()
+    embed = create_embed(
+        "🐢 Travamentos do Loop",
+        f"**Watchdog:** {'ativo ✅' if stats['enabled'] else 'desligado ❌'}\n"
+        f"**Atraso atual:** {health_monitor.loop_lag_ms:.1f}ms | **Máximo:** {health_monitor.max_loop_lag_ms:.1f}ms\n"
+        f"**Travamentos:** {stats['stalls']} (limite {LOOP_LAG_THRESHOLD_MS:.0f}ms)",
+        COLORS["warning"] if loop_watchdog.captures else COLORS["primary"]
+    )
+    captures = list(loop_watchdog.captures)[-max(1, min(quantidade, 5)):]
+    for capture in reversed(captures):
+        # Só o fim da pilha cabe no campo; é onde está o código que bloqueou
+        stack = capture["stack"][-900:]
+        embed.add_field(
+            name=f"{capture['lag_ms']}ms às {capture['at'][11:19]} (task {capture['task']}, {capture['hits']}/{capture['samples']})",
+            value=f"```py\n{stack}```",
+            inline=False
+        )
+    if not captures:
+        embed.add_field(name="Nenhuma captura", value="O loop não passou do limite desde o início", inline=False)
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="ajuda", description="❓ Ajuda e comandos")
 async def ajuda(interaction: discord.Interaction):
     embed = create_embed(
@@ -970,20 +4569,51 @@ async def ajuda(interaction: discord.Interaction):
 # ================= EVENTOS =================
 @bot.event
 async def on_ready():
+    if not startup.reported:
+        startup.mark("gateway")
+        startup.report()
     print(f"\n{'='*60}")
     print(f"🤖 POLARDEV BOT - ESPECIALISTA ROBLOX")
     print(f"🔗 Nome: {bot.user.name}")
     print(f"🆔 ID: {bot.user.id}")
     print(f"🎮 ESPECIALIDADE: Roblox Lua/Luau")
     print(f"🧠 IA: Groq (Llama 3 70B) - GRATUITA")
-    print(f"🌐 Flask: http://0.0.0.0:8080")
-    print(f"👥 Desenvolvedores: {len(db.users)}")
-    print(f"💬 Sistemas Roblox: {len(db.chats)}")
+    print(f"🌐 Servidor web: http://{WEB_HOST}:{WEB_PORT}")
+    print(f"👥 Desenvolvedores: {db.count_users()}")
+    print(f"💬 Sistemas Roblox: {db.count_chats()}")
     print(f"{'='*60}\n")
     print("✅ Bot 100% funcional como especialista Roblox!")
     print("💬 Agora responde mensagens normais de forma amigável")
     print("🎮 Botão de criação funcionando corretamente")
 
+async def handle_chat_message(message: discord.Message) -> str:
+    """Mensagem num canal de chat do PolarDev; retorna o desfecho (label das métricas)"""
+    # Ignora comandos com prefixo
+    if message.content.startswith(('/', '!', '\\')):
+        return "prefixed"
+    
+    # Limite de taxa antes do banco e da IA; avisa só uma vez por sequência de rejeições
+    retry_after, first_rejection = rate_limiter.hit("chat", message.author.id, message.guild.id)
+    if retry_after:
+        if first_rejection:
+            await message.reply(embed=slow_down_embed(retry_after), delete_after=min(retry_after, 15))
+        return "rate_limited"
+    
+    # Verifica se é um chat registrado
+    chat = db.get_chat(message.channel.id)
+    if chat is None:
+        return "unregistered"
+    if chat_expiry.touch(message.channel.id):
+        db.touch_chat(message.channel.id)
+    
+    if str(chat["owner_id"]) == str(message.author.id):
+        # Mensagens seguidas do dono viram uma pergunta só
+        chat_debouncer.submit(message)
+        return "queued"
+    
+    await answer_chat(message.channel, str(message.author.id), message.content, lambda: None)
+    return "answered"
+
 @bot.event
 async def on_message(message: discord.Message):
     # Ignora mensagens do próprio bot
@@ -991,81 +4621,112 @@ async def on_message(message: discord.Message):
         return
     
     # Se a mensagem é em um chat da categoria PolarDev
-    if message.channel.category and message.channel.category.name == CATEGORY_NAME:
-        # Verifica se é um chat registrado
-        if str(message.channel.id) not in db.chats:
+    if chat_categories.is_chat_category(getattr(message.channel, "category", None)):
+        started = time.perf_counter()
+        outcome = await handle_chat_message(message)
+        on_message_seconds.observe(time.perf_counter() - started, outcome=outcome)
+        if outcome == "prefixed":
             return
-        
-        # Ignora comandos com prefixo
-        if message.content.startswith(('/', '!', '\\')):
-            return
-        
-        try:
-            # Mostra que está digitando
-            async with message.channel.typing():
-                # Gera resposta
-                response = await ai.generate_response(message.content)
-            
-            # Envia a resposta
-            if response:
-                await message.channel.send(response)
-        
-        except Exception as e:
-            logger.error(f"Erro ao responder: {e}")
-            await message.channel.send("🤖 Oops, tive um problema ao processar sua mensagem. Tente novamente!")
     
     # Processa comandos normais do bot
     await bot.process_commands(message)
 
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    observe_command(interaction, "ok")
+
 # ================= MANUTENÇÃO PERIÓDICA =================
-@tasks.loop(minutes=30)
-async def cleanup_old_data():
-    """Limpa dados antigos periodicamente"""
-    try:
-        current_time = datetime.now()
-        # Remove chats muito antigos (30 dias)
-        old_chats = []
-        for channel_id, chat_data in db.chats.items():
-            created_at = datetime.fromisoformat(chat_data["created_at"])
-            if (current_time - created_at).days > 30:
-                old_chats.append(channel_id)
-        
-        for channel_id in old_chats:
-            del db.chats[channel_id]
-        
-        if old_chats:
-            db.save_all()
-            logger.info(f"Limpeza: removidos {len(old_chats)} chats antigos")
+@tasks.loop(seconds=CHAT_EXPIRY_INTERVAL)
+async def expire_chats():
+    """Arquiva e apaga, em lotes pequenos, os chats sem atividade há CHAT_EXPIRY_DAYS dias"""
+    for channel_id in chat_expiry.pop_due(CHAT_EXPIRY_BATCH):
+        # Cada chat já saiu do heap: uma falha só reagenda ele, sem perder o resto do lote
+        try:
+            await expire_chat(channel_id)
+        except Exception as e:
+            logger.error(f"Erro ao expirar o chat {channel_id}: {e}")
+            chat_expiry.retry_later(channel_id, 3600)
+
+async def expire_chat(channel_id: str):
+    chat_data = db.get_chat(channel_id)
+    if chat_data is None:
+        return
     
+    await archive_chat(channel_id, chat_data)
+    channel = bot.get_channel(int(channel_id))
+    if channel is not None:
+        try:
+            await channel.delete(reason=f"Chat PolarDev inativo há {CHAT_EXPIRY_DAYS:g} dias")
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            logger.warning(f"Não foi possível apagar o chat {channel_id}: {e}")
+            chat_expiry.retry_later(channel_id, 3600)
+            return
+        # Espaça as exclusões para não estourar o rate limit de canais do servidor
+        await asyncio.sleep(CHAT_EXPIRY_DELETE_SPACING)
+    
+    # on_guild_channel_delete já limpa; isto cobre canais que não existiam mais
+    ai.conversations.forget(channel_id)
+    chat_expiry.forget(channel_id)
+    db.remove_chat(channel_id)
+    chat_expiry.expired += 1
+    logger.info(f"Chat {channel_id} expirado e arquivado")
+
+@expire_chats.before_loop
+async def before_expire_chats():
+    await bot.wait_until_ready()
+
+@tasks.loop(minutes=10)
+async def persist_caches():
+    """Salva os caches da IA em disco periodicamente (escrita fora do loop)"""
+    try:
+        await ai.response_cache.persist()
+        await ai.system_cache.persist()
+    except Exception as e:
+        logger.error(f"Erro ao salvar caches: {e}")
+
+@tasks.loop(minutes=5)
+async def evict_idle_conversations():
+    """Tira da memória as conversas de canais ociosos (ficam em disco)"""
+    try:
+        evicted = await ai.conversations.evict_idle(CONVERSATION_IDLE_SECONDS)
+        if evicted:
+            logger.info(f"Memória de conversa: {evicted} canais ociosos gravados em disco")
     except Exception as e:
-        logger.error(f"Erro na limpeza: {e}")
+        logger.error(f"Erro ao liberar conversas: {e}")
 
 @bot.event
 async def on_guild_channel_delete(channel):
     """Remove chat do banco de dados quando o canal é deletado"""
-    if str(channel.id) in db.chats:
-        del db.chats[str(channel.id)]
-        db.save_all()
+    if isinstance(channel, discord.CategoryChannel):
+        chat_categories.forget(channel)
+        return
+    ai.conversations.forget(channel.id)
+    chat_debouncer.forget(channel.id)
+    chat_expiry.forget(channel.id)
+    if db.remove_chat(channel.id):
         logger.info(f"Canal {channel.id} removido do banco de dados")
+    if channel.category is not None:
+        await chat_categories.reclaim(channel.category)
 
 # ================= INICIALIZAÇÃO =================
+startup.mark("módulo")
+
 if __name__ == "__main__":
     print("\n" + "="*60)
     print("🚀 INICIANDO POLARDEV - ESPECIALISTA ROBLOX")
     print("="*60 + "\n")
     
-    keep_alive()
-    print("✅ Flask iniciado - Bot sempre ativo no Render")
-    
     try:
         bot.run(TOKEN)
     except KeyboardInterrupt:
         print("\n👋 Bot interrompido pelo usuário")
-        db.save_all()
     except discord.LoginFailure:
         print("❌ TOKEN DO DISCORD INVÁLIDO!")
         print("Verifique o arquivo .env")
     except Exception as e:
         print(f"❌ ERRO CRÍTICO: {e}")
-        import traceback
         traceback.print_exc()
+    finally:
+        db.close()